@@ -0,0 +1,124 @@
+"""Helpers shared by the example pipelines."""
+import os
+import subprocess
+from pathlib import Path
+from xml.sax.saxutils import escape
+from osgeo import gdal
+
+# NDVI computed on the fly from band 4 (NIR) and band 1 (red) of the orthophoto.
+ndvi_vrt_template = """<VRTDataset rasterXSize="{xsize}" rasterYSize="{ysize}">
+  <SRS>{srs}</SRS>
+  <GeoTransform>{geotransform}</GeoTransform>
+  <VRTRasterBand dataType="Float32" band="1" subClass="VRTDerivedRasterBand">
+    <PixelFunctionType>ndvi</PixelFunctionType>
+    <PixelFunctionLanguage>Python</PixelFunctionLanguage>
+    <PixelFunctionCode><![CDATA[
+def ndvi(in_ar, out_ar, *args, **kwargs):
+    nir = in_ar[0].astype(float)
+    red = in_ar[1]
+    out_ar[:] = (nir - red) / (nir + red)
+]]>
+    </PixelFunctionCode>
+    <SimpleSource>
+      <SourceFilename relativeToVRT="0">{srcfile}</SourceFilename>
+      <SourceBand>4</SourceBand>
+    </SimpleSource>
+    <SimpleSource>
+      <SourceFilename relativeToVRT="0">{srcfile}</SourceFilename>
+      <SourceBand>1</SourceBand>
+    </SimpleSource>
+  </VRTRasterBand>
+</VRTDataset>
+"""
+# Allow the pixel function to run when ndvi.vrt is read in this process
+gdal.SetConfigOption("GDAL_VRT_ENABLE_PYTHON", "YES")
+
+# Use ZSTD when the GDAL build supports it, as surfclass.rasterio does. ZSTD requires GDAL to be
+# built with libzstd, otherwise COMPRESS=DEFLATE is used
+cog_compress = (
+    "ZSTD"
+    if "ZSTD"
+    in (gdal.GetDriverByName("COG").GetMetadataItem("DMD_CREATIONOPTIONLIST") or "")
+    else "DEFLATE"
+)
+# Write final rasters as Cloud Optimized GeoTIFFs: fixed 512x512 blocks and internal overviews,
+# so the VRTs built on top of them are read block by block instead of scanline by scanline.
+# PREDICTOR=YES picks horizontal differencing for integer and floating point prediction for float
+# rasters.
+cog_options = ["-of", "COG", "-co", f"COMPRESS={cog_compress}", "-co", "PREDICTOR=YES"]
+cog_options += ["-co", "BLOCKSIZE=512", "-co", "BIGTIFF=IF_SAFER"]
+cog_options += ["-co", "OVERVIEWS=IGNORE_EXISTING", "-co", "NUM_THREADS=ALL_CPUS"]
+# Class rasters must not be averaged when building overviews
+cog_class_options = cog_options + ["-co", "RESAMPLING=NEAREST"]
+
+# Environment of the commands started by `run`, see `configure_gdal`
+gdal_env = dict(os.environ)
+
+
+def configure_gdal(cachemax="50%"):
+    """Sets the GDAL settings used both by the GDAL commands and when reading rasters in this process.
+
+    Args:
+        cachemax (str, optional): GDAL_CACHEMAX, the RAM used for block caches. Defaults to half
+            of the RAM.
+
+    """
+    gdal_config = {
+        "GDAL_CACHEMAX": cachemax,
+        "GDAL_NUM_THREADS": "ALL_CPUS",
+        # Let every thread open its own VRT sources instead of queueing for shared ones
+        "VRT_SHARED_SOURCE": "0",
+    }
+    gdal_env.update(gdal_config)
+    for key, value in gdal_config.items():
+        gdal.SetConfigOption(key, value)
+
+
+def needs_rebuild(dst, srcs):
+    """Make style check. True if dst is missing or older than any of the existing srcs."""
+    dst = Path(dst)
+    if not dst.exists():
+        return True
+    mtime = dst.stat().st_mtime
+    return any(Path(s).stat().st_mtime > mtime for s in srcs if Path(s).exists())
+
+
+def run(args):
+    # Pass the arguments as a list of str, so no shell is involved in quoting paths
+    args = [str(a) for a in args]
+    print("Running: ", args)
+    subprocess.run(args, check=True, env=gdal_env)
+
+
+def build_vrt_from_files(vrtfile, files):
+    if not needs_rebuild(vrtfile, files):
+        print("%s is up to date. Skipping" % vrtfile)
+        return
+    # Hand the list of input files to gdalbuildvrt instead of a shell glob
+    listfile = vrtfile.with_suffix(".lst")
+    listfile.write_text("\n".join(str(x) for x in files))
+    args = ["gdalbuildvrt"]
+    args += ["-resolution", "user"]
+    # Cover entire DK + margin
+    args += ["-tap"]
+    args += ["-tr", "0.4", "0.4"]
+    args += ["-te", "440000", "6048000", "895000", "6404000"]
+    args += ["-input_file_list", str(listfile)]  # Input files
+    args += [str(vrtfile)]  # Output vrt
+    run(args)
+
+
+def write_ndvi_vrt(srcfile, vrtfile):
+    if not needs_rebuild(vrtfile, [srcfile]):
+        print("%s is up to date. Skipping" % vrtfile)
+        return
+    ds = gdal.Open(str(srcfile))
+    xml = ndvi_vrt_template.format(
+        xsize=ds.RasterXSize,
+        ysize=ds.RasterYSize,
+        srs=escape(ds.GetProjection()),
+        geotransform=", ".join(repr(x) for x in ds.GetGeoTransform()),
+        srcfile=escape(str(Path(srcfile).resolve())),
+    )
+    ds = None
+    vrtfile.write_text(xml)
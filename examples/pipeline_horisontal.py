@@ -1,6 +1,19 @@
-import subprocess
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import shutil
+from osgeo import gdal
+from surfclass.kernelfeatureextraction import KernelFeatureExtraction
+from surfclass import noise, rasterio
+from surfclass.tiles import TILES_4KM
+from common import (
+    build_vrt_from_files,
+    cog_class_options,
+    configure_gdal,
+    needs_rebuild,
+    run,
+    write_ndvi_vrt,
+)
 
 # ------------------------------------------------------------------------------------------
 # This is an example of how to classify multiple tiles horizontally, by creating .vrt files
@@ -12,12 +25,8 @@ import shutil
 # Northings 6177, 6178, 6179, 6180
 # -----------------------------------------------------------------------------------------
 
-e_range = range(722, 726)
-n_range = range(6177, 6181)
-tiles = []
-for e in e_range:
-    for n in n_range:
-        tiles.append((n, e))
+# (n, e) tuples matching the tile names, e.g. 1km_6177_722
+tiles = TILES_4KM.tolist()
 
 
 out_dir = Path("./tmp4")
@@ -34,12 +43,44 @@ modelfile = Path(
 dimensions = ["Amplitude", "Pulsewidth", "ReturnNumber"]
 geodkdb = "/Volumes/Macintosh HD/Volumes/GoogleDrive/My Drive/Septima - Ikke synkroniseret/Projekter/SDFE/Befæstelse/data/geodk.gpkg"
 
+# Selects the features of a GeoDanmark layer overlapping a bbox using the spatial index
+# GDAL creates for GeoPackage layers (fid and geom are the GDAL default column names)
+geodk_bbox_sql = (
+    'SELECT * FROM "{layer}" WHERE fid IN (SELECT id FROM "rtree_{layer}_geom" '
+    "WHERE maxx >= {bbox[0]} AND minx <= {bbox[2]} AND maxy >= {bbox[1]} AND miny <= {bbox[3]})"
+)
+
+# Number of tiles processed at the same time. Most of the heavy lifting is done in external processes
+# (surfclass, gdal) or in numpy, so a pool of threads is enough to keep all cores busy.
+# Lower this if the machine runs out of memory.
+max_workers = os.cpu_count()
+
+# GDAL settings used both by the GDAL commands and when reading rasters in this process.
+# Half of the RAM for block caches, shared between the tiles processed at the same time
+configure_gdal(cachemax="%d%%" % max(1, 50 // max_workers))
+
+
+def run_parallel(func, items, *tasks):
+    """Calls func on every item and runs the extra tasks using a pool of max_workers threads."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(task) for task in tasks]
+        futures += [executor.submit(func, item) for item in items]
+        # Wait for the results to make exceptions from the workers propagate
+        for future in futures:
+            future.result()
+
+
+def build_vrt(vrt_and_pattern):
+    vrtfile, pattern = vrt_and_pattern
+    build_vrt_from_files(out_dir / vrtfile, sorted(out_dir.glob(pattern)))
+
 
 # Do all lidar gridding
 def process_lidar_tile(t):
     n, e = t
     kvnet = "1km_%s_%s" % (n, e)
-    if (out_dir / ("%s_Amplitude.tif" % kvnet)).exists():
+    lasfile = las_dir / (kvnet + ".las")
+    if not needs_rebuild(out_dir / ("%s_Amplitude.tif" % kvnet), [lasfile]):
         print("Existing grids found for %s. Skipping" % kvnet)
         return
     bbox = (e * 1000, n * 1000, e * 1000 + 1000, n * 1000 + 1000)
@@ -50,70 +91,35 @@ def process_lidar_tile(t):
     for d in ["Amplitude", "Pulse width", "ReturnNumber"]:
         args += ["-d", d]
     args += ["--prefix", "%s_" % kvnet]
-    args += [las_dir / (kvnet + ".las")]
+    args += [lasfile]
     args += [out_dir]
-    print("Running: ", args)
-    subprocess.run(args, check=True)
+    run(args)
 
 
-print("Grid lidar files")
-for t in tiles:
-    process_lidar_tile(t)
+def build_ndvi_vrt():
+    # Mosaic of the orthophotos on the same 0.4m grid as the lidar rasters
+    ortofile = out_dir / "orto.vrt"
+    build_vrt_from_files(
+        ortofile, [orto_dir / ("2019_1km_%s_%s.tif" % t) for t in tiles]
+    )
+    write_ndvi_vrt(ortofile, out_dir / "ndvi.vrt")
 
-print("Make GDAL vrts")
-for d in dimensions:
-    args = ["gdalbuildvrt"]
-    args += ["-resolution", "user"]
-    # Cover entire DK + margin
-    args += ["-tap"]
-    args += ["-tr", "0.4", "0.4"]
-    args += ["-te", "440000", "6048000", "895000", "6404000"]
-    args += ["%s/%s.vrt" % (out_dir, d)]  # Output vrt
-    args += ["%s/*_%s.tif" % (out_dir, d)]  # Input files
-    print("Running: ", args)
-    subprocess.Popen(" ".join(args), shell=True).wait()
-
-
-print("Process NDVI")
-for t in tiles:
-    kvnet = "1km_%s_%s" % t
-    srcfile = orto_dir / ("2019_%s.tif" % kvnet)
-    tmpfile = out_dir / ("tmp_%s.tif" % kvnet)
-    dstfile = out_dir / ("%s_ndvi.tif" % kvnet)
-    if dstfile.exists():
-        print("Existing NDVI found for %s. Skipping" % kvnet)
-        continue
-    # Resample to 0.4m
-    args = ["gdal_translate"]
-    args += ["-co", "tiled=yes", "-co", "compress=deflate"]
-    args += ["-tr", "0.4", "0.4"]
-    args += [srcfile, tmpfile]
-    print("Running: ", args)
-    subprocess.run(args, check=True)
-    # Calculate ndvi
-    args = ["gdal_calc.py"]
-    args += ["-A", tmpfile, "--A_band=4"]
-    args += ["-B", tmpfile, "--B_band=1"]
-    args += ["--creation-option", "compress=deflate"]
-    args += ["--creation-option", "tiled=true"]
-    args += ["--type", "Float32"]
-    args += ["--calc", "(A.astype(float)-B)/(A.astype(float)+B)"]
-    args += ["--outfile", dstfile]
-    print("Running: ", args)
-    subprocess.run(args, check=True)
-    tmpfile.unlink()
-
-print("Make GDAL vrts for NDVI")
-args = ["gdalbuildvrt"]
-args += ["-resolution", "user"]
-# Cover entire DK + margin
-args += ["-tap"]
-args += ["-tr", "0.4", "0.4"]
-args += ["-te", "440000", "6048000", "895000", "6404000"]
-args += [str(out_dir / "ndvi.vrt")]  # Output vrt
-args += [str(out_dir / "1km_*_ndvi.tif")]  # Input files
-print("Running: ", args)
-subprocess.Popen(" ".join(args), shell=True).wait()
+
+def extract_features(kvnet, d, bbox):
+    # Calculate all features in-process from a single read of the raster. NDVI is calculated on
+    # the fly when ndvi.vrt is read, so no NDVI rasters are ever written
+    extractor = KernelFeatureExtraction(
+        str(out_dir / ("%s.vrt" % d)),
+        str(out_dir),
+        ["mean", "var", "diffmean"],
+        neighborhood=5,
+        crop_mode="crop",
+        bbox=bbox,
+        prefix="%s_%s_" % (kvnet, d),
+        # The tiles are already processed in parallel threads
+        n_workers=1,
+    )
+    extractor.start()
 
 
 def process_derived(t):
@@ -122,177 +128,170 @@ def process_derived(t):
     # Caculate bbox including edge for kernel
     bbox = (e * 1000 - 0.8, n * 1000 - 0.8, e * 1000 + 1000.8, n * 1000 + 1000.8)
     for d in ["Amplitude", "Pulsewidth", "ndvi"]:
-        if (out_dir / ("%s_%s_mean.tif" % (kvnet, d))).exists():
+        srcfile = out_dir / ("%s.vrt" % d)
+        if not needs_rebuild(out_dir / ("%s_%s_mean.tif" % (kvnet, d)), [srcfile]):
             print("Existing derived features found for %s_%s. Skipping" % (kvnet, d))
             continue
-        args = ["surfclass", "prepare", "extractfeatures"]
-        args += ["--bbox"] + [str(x) for x in bbox]
-        args += ["-n", "5"]
-        args += ["-c", "crop"]
-        args += ["--prefix", "%s_%s_" % (kvnet, d)]
-        args += ["-f", "mean"]
-        args += ["-f", "var"]
-        args += ["-f", "diffmean"]
-        args += ["%s/%s.vrt" % (out_dir.resolve(), d)]
-        args += [out_dir]
-        print("Running: ", args)
-        subprocess.run(args, check=True)
+        extract_features(kvnet, d, bbox)
 
 
-print("Calculate derived features")
-for t in tiles:
-    process_derived(t)
-
-print("Make GDAL vrts for derived features")
-for d in ("Amplitude", "Pulsewidth", "ndvi"):
-    for m in ("mean", "var", "diffmean"):
-        args = ["gdalbuildvrt"]
-        args += ["-resolution", "user"]
-        # Cover entire DK + margin
-        args += ["-tap"]
-        args += ["-tr", "0.4", "0.4"]
-        args += ["-te", "440000", "6048000", "895000", "6404000"]
-        args += ["%s/%s_%s.vrt" % (out_dir, d, m)]  # Output vrt
-        args += ["%s/*_%s_%s.tif" % (out_dir, d, m)]  # Input files
-        print("Running: ", args)
-        subprocess.Popen(" ".join(args), shell=True).wait()
-
-print("Run classification")
-for t in tiles:
+def classify_tile(t):
     n, e = t
     kvnet = "1km_%s_%s" % (n, e)
     bbox = (e * 1000, n * 1000, e * 1000 + 1000, n * 1000 + 1000)
     dstfile = out_dir / ("%s_classification.tif" % kvnet)
     probfile = out_dir / ("%s_classification_prob.tif" % kvnet)
-    if dstfile.exists():
+    features = [
+        out_dir / ("%s.vrt" % f)
+        for f in [
+            "Amplitude_diffmean",
+            "Amplitude_mean",
+            "Amplitude_var",
+            "ndvi_diffmean",
+            "ndvi_mean",
+            "ndvi_var",
+            "pulsewidth_diffmean",
+            "pulsewidth_mean",
+            "pulsewidth_var",
+            "returnnumber",
+        ]
+    ]
+    if not needs_rebuild(dstfile, features + [modelfile]):
         print("%s exists. Skipping" % dstfile)
-        continue
+        return
     args = ["surfclass", "classify", "randomforestndvi"]
     args += ["--bbox"] + [str(x) for x in bbox]
-    args += ["-f1", out_dir / "Amplitude_diffmean.vrt"]
-    args += ["-f2", out_dir / "Amplitude_mean.vrt"]
-    args += ["-f3", out_dir / "Amplitude_var.vrt"]
-    args += ["-f4", out_dir / "ndvi_diffmean.vrt"]
-    args += ["-f5", out_dir / "ndvi_mean.vrt"]
-    args += ["-f6", out_dir / "ndvi_var.vrt"]
-    args += ["-f7", out_dir / "pulsewidth_diffmean.vrt"]
-    args += ["-f8", out_dir / "pulsewidth_mean.vrt"]
-    args += ["-f9", out_dir / "pulsewidth_var.vrt"]
-    args += ["-f10", out_dir / "returnnumber.vrt"]
+    for i, f in enumerate(features, 1):
+        args += ["-f%d" % i, f]
     args += ["--prob", probfile]
+    # Each tile already runs in its own thread. Don't let every tile use all cores as well
+    args += ["--processors", "1"]
     args += [modelfile]
     args += [dstfile]
-    print("Running: ", args)
-    subprocess.run(args, check=True)
+    run(args)
 
 
-print("Make GDAL vrts for classified")
-args = ["gdalbuildvrt"]
-args += ["-resolution", "user"]
-args += ["-tap"]
-args += ["-tr", "0.4", "0.4"]
-args += ["-te", "440000", "6048000", "895000", "6404000"]
-args += [str(out_dir / "classification.vrt")]  # Output vrt
-args += [str(out_dir / "1km_*_classification.tif")]  # Input files
-print("Running: ", args)
-subprocess.Popen(" ".join(args), shell=True).wait()
-# Probability
-args = ["gdalbuildvrt"]
-args += ["-resolution", "user"]
-args += ["-tap"]
-args += ["-tr", "0.4", "0.4"]
-args += ["-te", "440000", "6048000", "895000", "6404000"]
-args += [str(out_dir / "classification_prob.vrt")]  # Output vrt
-args += [str(out_dir / "1km_*_classification_prob.tif")]  # Input files
-print("Running: ", args)
-subprocess.Popen(" ".join(args), shell=True).wait()
-
-print("Denoise")
-for t in tiles:
+# Readers of classification.vrt, one per worker thread
+thread_data = threading.local()
+
+
+def classification_reader():
+    # GDAL datasets can't be shared between threads, so every worker opens the VRT once and
+    # reuses it for all the tiles it denoises
+    if not hasattr(thread_data, "reader"):
+        thread_data.reader = rasterio.RasterReader(out_dir / "classification.vrt")
+    return thread_data.reader
+
+
+def denoise_tile(t):
     n, e = t
     kvnet = "1km_%s_%s" % (n, e)
     bbox = (e * 1000, n * 1000, e * 1000 + 1000, n * 1000 + 1000)
     # Add buffer to reduce nearest neighbor artefacts
     bbox_buffer = (bbox[0] - 20, bbox[1] - 20, bbox[2] + 20, bbox[3] + 20)
     srcfile = out_dir / ("classification.vrt")
-    tmpfile = out_dir / ("tmp_%s_classification_denoised.tif" % kvnet)
+    tmpfile = "/vsimem/%s_classification_denoised.tif" % kvnet
     dstfile = out_dir / ("%s_classification_denoised.tif" % kvnet)
-    if dstfile.exists():
+    if not needs_rebuild(dstfile, [srcfile]):
         print("%s exists. Skipping" % dstfile)
-        continue
-    args = ["surfclass", "extract", "denoise"]
-    args += ["--bbox"] + [str(x) for x in bbox_buffer]
-    args += [srcfile, tmpfile]
-    print("Running: ", args)
-    subprocess.run(args, check=True)
+        return
+    print("Denoising %s" % kvnet)
+    reader = classification_reader()
+    data = reader.read_raster(bbox=bbox_buffer, masked=True)
+    denoised = noise.denoise(data)
     # Crop away edges
-    args = ["gdal_translate"]
-    args += ["-co", "tiled=true"]
-    args += ["-co", "compress=deflate"]
-    args += ["-projwin", str(bbox[0]), str(bbox[3]), str(bbox[2]), str(bbox[1])]
-    args += [tmpfile]
-    args += [dstfile]
-    print("Running: ", args)
-    subprocess.run(args, check=True)
-    tmpfile.unlink()
-
-print("Make GDAL vrts for denoised")
-args = ["gdalbuildvrt"]
-args += ["-resolution", "user"]
-# Cover entire DK + margin
-args += ["-tap"]
-args += ["-tr", "0.4", "0.4"]
-args += ["-te", "440000", "6048000", "895000", "6404000"]
-args += [str(out_dir / "classification_denoised.vrt")]  # Output vrt
-args += [str(out_dir / "1km_*_classification_denoised.tif")]  # Input files
-print("Running: ", args)
-subprocess.Popen(" ".join(args), shell=True).wait()
-
-print("Burn buildings and lakes")
-for t in tiles:
+    edge = int(round(20 / reader.resolution))
+    denoised = denoised[edge:-edge, edge:-edge]
+    rasterio.write_to_file(
+        tmpfile, denoised, (bbox[0], bbox[3]), reader.resolution, reader.srs
+    )
+    gdal.Translate(str(dstfile), tmpfile, options=cog_class_options)
+    gdal.Unlink(tmpfile)
+
+
+def burn_tile(t):
     kvnet = "1km_%s_%s" % t
     n, e = t
     bbox = (e * 1000, n * 1000, e * 1000 + 1000, n * 1000 + 1000)
     srcfile = out_dir / ("%s_classification_denoised.tif" % kvnet)
-    tmpfile = out_dir / ("tmp_%s_classification_denoised_burn.tif" % kvnet)
+    tmpfile = "/vsimem/%s_classification_denoised_burn.tif" % kvnet
     dstfile = out_dir / ("%s_classification_denoised_burn.tif" % kvnet)
-    if dstfile.exists():
+    if not needs_rebuild(dstfile, [srcfile, geodkdb]):
         print("%s exists. Skipping" % dstfile)
-        continue
-    shutil.copy(srcfile, tmpfile)
+        return
+    print("Burning %s" % kvnet)
+    # Burn into an in-memory copy and convert it to COG once at the end. Burning straight into
+    # the COG dstfile would leave its overviews stale and break the COG layout
+    ds = gdal.Translate(tmpfile, str(srcfile))
     for classid, layername in [
         (8, "geodanmark_60_nohist.bygning"),
         (9, "geodanmark_60_nohist.soe"),
     ]:
-        # gdal_rasterize is is slow with large input vector datasets
-        # Extract bbox from database
-        tmpgeom = out_dir / ("tmp_%s.geojson" % kvnet)
-        args = ["ogr2ogr"]
-        args += ["-f", "GeoJSON"]
-        args += ["-spat"] + [str(x) for x in bbox]
-        args += [tmpgeom, geodkdb, layername]
-        print("Running: ", " ".join(map(str, args)))
-        subprocess.run(args, check=True)
-        # Now use subset
-        args = ["gdal_rasterize"]
-        args += ["-burn", str(classid)]
-        # args += ["-l", layername]
-        args += [tmpgeom]
-        args += [tmpfile]
-        print("Running: ", " ".join(map(str, args)))
-        subprocess.run(args, check=True)
-        tmpgeom.unlink()
-    shutil.copy(tmpfile, dstfile)
-    tmpfile.unlink()
-
-print("Make GDAL vrts for denoised burned")
-args = ["gdalbuildvrt"]
-args += ["-resolution", "user"]
-# Cover entire DK + margin
-args += ["-tap"]
-args += ["-tr", "0.4", "0.4"]
-args += ["-te", "440000", "6048000", "895000", "6404000"]
-args += [str(out_dir / "classification_denoised_burn.vrt")]  # Output vrt
-args += [str(out_dir / "1km_*_classification_denoised_burn.tif")]  # Input files
-print("Running: ", args)
-subprocess.Popen(" ".join(args), shell=True).wait()
+        # gdal_rasterize is slow with large input vector datasets. Select the features
+        # overlapping the tile through the R-tree of the GeoPackage
+        gdal.Rasterize(
+            ds,
+            str(geodkdb),
+            burnValues=[classid],
+            SQLStatement=geodk_bbox_sql.format(layer=layername, bbox=bbox),
+        )
+    gdal.Translate(str(dstfile), ds, options=cog_class_options)
+    ds = None
+    gdal.Unlink(tmpfile)
+
+
+def denoise_and_burn_tile(t):
+    # Burning only needs the denoised tile itself, so there is no reason to wait for other tiles
+    denoise_tile(t)
+    burn_tile(t)
+
+
+# Stages only wait for each other where a tile needs its neighbors (the kernel features and the
+# denoise buffer read across tile edges) or where a VRT mosaics all tiles. Everything else is
+# submitted to the same pool of workers.
+print("Grid lidar files and make GDAL vrts for NDVI")
+run_parallel(process_lidar_tile, tiles, build_ndvi_vrt)
+
+print("Make GDAL vrts")
+run_parallel(build_vrt, [("%s.vrt" % d, "*_%s.tif" % d) for d in dimensions])
+
+print("Calculate derived features")
+run_parallel(process_derived, tiles)
+
+print("Make GDAL vrts for derived features")
+run_parallel(
+    build_vrt,
+    [
+        ("%s_%s.vrt" % (d, m), "*_%s_%s.tif" % (d, m))
+        for d in ("Amplitude", "Pulsewidth", "ndvi")
+        for m in ("mean", "var", "diffmean")
+    ],
+)
+
+print("Run classification")
+run_parallel(classify_tile, tiles)
+
+print("Make GDAL vrts for classified")
+run_parallel(
+    build_vrt,
+    [
+        ("classification.vrt", "1km_*_classification.tif"),
+        # Probability
+        ("classification_prob.vrt", "1km_*_classification_prob.tif"),
+    ],
+)
+
+print("Denoise and burn buildings and lakes")
+run_parallel(denoise_and_burn_tile, tiles)
+
+print("Make GDAL vrts for denoised and denoised burned")
+run_parallel(
+    build_vrt,
+    [
+        ("classification_denoised.vrt", "1km_*_classification_denoised.tif"),
+        (
+            "classification_denoised_burn.vrt",
+            "1km_*_classification_denoised_burn.tif",
+        ),
+    ],
+)
@@ -1,3 +1,4 @@
+import os
 import subprocess
 from pathlib import Path
 
@@ -31,8 +32,25 @@ for n in range(tile_n - 1, tile_n + 1):
     for e in range(tile_e - 1, tile_e + 2):
         las_files.append("%s/1km_%s_%s.las" % (las_dir, n, e))
 
+# GDAL settings used by all GDAL commands
+gdal_config = {
+    # Use half of the RAM for the block cache
+    "GDAL_CACHEMAX": "50%",
+    "GDAL_NUM_THREADS": "ALL_CPUS",
+}
+gdal_env = dict(os.environ, **gdal_config)
+
+
+def run(args):
+    # Pass the arguments as a list of str, so no shell is involved in quoting paths
+    args = [str(a) for a in args]
+    print("Running: ", args)
+    subprocess.run(args, check=True, env=gdal_env)
+
 
 print("Grid Lidar data with buffer to allow calculation of kernel features")
+# lidargrid crops every file to the buffered bbox as soon as it is read, so only the points in
+# the buffer are kept from the neighbor files
 args = ["surfclass", "prepare", "lidargrid"]
 args += ["--srs", "epsg:25832"]
 args += ["-r", str(resolution)]
@@ -42,8 +60,7 @@ for d in dimensions:
 args += ["--prefix", "%s_" % tile_kvnet]
 args += las_files
 args += [out_dir]
-print("Running: ", args)
-subprocess.run(args, check=True)
+run(args)
 
 print("Calculate kernel features")
 for d in ["Amplitude", "Pulsewidth"]:
@@ -57,8 +74,7 @@ for d in ["Amplitude", "Pulsewidth"]:
     args += ["-f", "diffmean"]
     args += ["%s/%s_%s.tif" % (out_dir, tile_kvnet, d)]
     args += [out_dir]
-    print("Running: ", args)
-    subprocess.run(args, check=True)
+    run(args)
 
 print("Crop away buffer from gridded lidar")
 x = y = buffer_cells
@@ -72,8 +88,7 @@ for d in ["Amplitude", "Pulsewidth", "ReturnNumber"]:
     args += ["-srcwin", str(x), str(y), str(width), str(height)]
     args += [f]
     args += [tmpfile]
-    print("Running: ", args)
-    subprocess.run(args, check=True)
+    run(args)
     Path(f).unlink()
     Path(tmpfile).rename(f)
 
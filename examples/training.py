@@ -10,15 +10,26 @@
 # entire area (with nodata where there are no tiles).
 # ----------------------------------------------------------------------------------
 
-import subprocess
 from pathlib import Path
 import shutil
+from surfclass.kernelfeatureextraction import KernelFeatureExtraction
+from common import (
+    build_vrt_from_files,
+    configure_gdal,
+    needs_rebuild,
+    run,
+    write_ndvi_vrt,
+)
 
 tiles = [(6167, 729), (6171, 727), (6176, 724), (6184, 720), (6211, 689), (6220, 717)]
 
 out_dir = Path("tmp3")
 dimensions = ["Amplitude", "Pulsewidth", "ReturnNumber"]
 
+# GDAL settings used both by the GDAL commands and when reading rasters in this process. Half of
+# the RAM is used for the block cache
+configure_gdal()
+
 las_dir = Path(
     "/Volumes/Macintosh HD/Volumes/GoogleDrive/My Drive/Septima - Ikke synkroniseret/Projekter/SDFE/Befæstelse/data/trænings_las"
 )
@@ -31,6 +42,21 @@ train_lyr = "train_polys_all"
 train_class_attribute = "class"
 
 
+# Features used for training, in the order the model expects them
+train_features = [
+    "Amplitude_diffmean",
+    "Amplitude_mean",
+    "Amplitude_var",
+    "ndvi_diffmean",
+    "ndvi_mean",
+    "ndvi_var",
+    "Pulsewidth_diffmean",
+    "Pulsewidth_mean",
+    "Pulsewidth_var",
+    "ReturnNumber",
+]
+
+
 def process_lidar(tiles, las_dir, out_dir):
     print("Grid lidar files")
     for t in tiles:
@@ -41,7 +67,8 @@ def process_lidar(tiles, las_dir, out_dir):
 def process_lidar_tile(t, las_dir, out_dir):
     n, e = t
     kvnet = "1km_%s_%s" % (n, e)
-    if (out_dir / ("%s_Amplitude.tif" % kvnet)).exists():
+    lasfile = las_dir / (kvnet + ".las")
+    if not needs_rebuild(out_dir / ("%s_Amplitude.tif" % kvnet), [lasfile]):
         print("Existing grids found for %s. Skipping" % kvnet)
         return
     bbox = (e * 1000, n * 1000, e * 1000 + 1000, n * 1000 + 1000)
@@ -52,70 +79,29 @@ def process_lidar_tile(t, las_dir, out_dir):
     for d in ["Amplitude", "Pulse width", "ReturnNumber"]:
         args += ["-d", d]
     args += ["--prefix", "%s_" % kvnet]
-    args += [str(las_dir / (kvnet + ".las"))]
+    args += [lasfile]
     args += [str(out_dir)]
-    print("Running: ", args)
-    subprocess.run(args, check=True)
+    run(args)
+
+
+def build_vrt(out_dir, vrtfile, pattern):
+    build_vrt_from_files(out_dir / vrtfile, sorted(out_dir.glob(pattern)))
 
 
 def gdal_vrt_lidar(dimensions, out_dir):
     print("Make GDAL vrts")
     for d in dimensions:
-        args = ["gdalbuildvrt"]
-        args += ["-resolution", "user"]
-        # Cover entire DK + margin
-        args += ["-tap"]
-        args += ["-tr", "0.4", "0.4"]
-        args += ["-te", "440000", "6048000", "895000", "6404000"]
-        args += ["%s/%s.vrt" % (out_dir, d)]  # Output vrt
-        args += ["%s/*_%s.tif" % (out_dir, d)]  # Input files
-        print("Running: ", args)
-        subprocess.Popen(" ".join(args), shell=True).wait()
-
-
-def process_ndvi(tiles, orto_dir, out_dir):
-    print("Process NDVI")
-    for t in tiles:
-        kvnet = "1km_%s_%s" % t
-        srcfile = orto_dir / ("2019_%s.tif" % kvnet)
-        tmpfile = out_dir / ("tmp_%s.tif" % kvnet)
-        dstfile = out_dir / ("%s_ndvi.tif" % kvnet)
-        if dstfile.exists():
-            print("Existing NDVI found for %s. Skipping" % kvnet)
-            continue
-        # Resample to 0.4m
-        args = ["gdal_translate"]
-        args += ["-co", "tiled=yes", "-co", "compress=deflate"]
-        args += ["-tr", "0.4", "0.4"]
-        args += [srcfile, tmpfile]
-        print("Running: ", args)
-        subprocess.run(args, check=True)
-        # Calculate ndvi
-        args = ["gdal_calc.py"]
-        args += ["-A", tmpfile, "--A_band=4"]
-        args += ["-B", tmpfile, "--B_band=1"]
-        args += ["--creation-option", "compress=deflate"]
-        args += ["--creation-option", "tiled=true"]
-        args += ["--type", "Float32"]
-        args += ["--calc", "(A.astype(float)-B)/(A.astype(float)+B)"]
-        args += ["--outfile", dstfile]
-        print("Running: ", args)
-        subprocess.run(args, check=True)
-        tmpfile.unlink()
-
-
-def gdal_vrt_ndvi(out_dir):
+        build_vrt(out_dir, "%s.vrt" % d, "*_%s.tif" % d)
+
+
+def gdal_vrt_ndvi(tiles, orto_dir, out_dir):
     print("Make GDAL vrts for NDVI")
-    args = ["gdalbuildvrt"]
-    args += ["-resolution", "user"]
-    # Cover entire DK + margin
-    args += ["-tap"]
-    args += ["-tr", "0.4", "0.4"]
-    args += ["-te", "440000", "6048000", "895000", "6404000"]
-    args += [str(out_dir / "ndvi.vrt")]  # Output vrt
-    args += [str(out_dir / "1km_*_ndvi.tif")]  # Input files
-    print("Running: ", args)
-    subprocess.Popen(" ".join(args), shell=True).wait()
+    # Mosaic of the orthophotos on the same 0.4m grid as the lidar rasters
+    ortofile = out_dir / "orto.vrt"
+    build_vrt_from_files(
+        ortofile, [orto_dir / ("2019_1km_%s_%s.tif" % t) for t in tiles]
+    )
+    write_ndvi_vrt(ortofile, out_dir / "ndvi.vrt")
 
 
 def process_derived(tiles, out_dir):
@@ -124,80 +110,64 @@ def process_derived(tiles, out_dir):
         process_derived_tile(t, out_dir)
 
 
+def extract_features(kvnet, d, bbox, out_dir):
+    # Calculate all features in-process from a single read of the raster. NDVI is calculated on
+    # the fly when ndvi.vrt is read, so no NDVI rasters are ever written
+    extractor = KernelFeatureExtraction(
+        str(out_dir / ("%s.vrt" % d)),
+        str(out_dir),
+        ["mean", "var", "diffmean"],
+        neighborhood=5,
+        crop_mode="crop",
+        bbox=bbox,
+        prefix="%s_%s_" % (kvnet, d),
+    )
+    extractor.start()
+
+
 def process_derived_tile(t, out_dir):
     n, e = t
     kvnet = "1km_%s_%s" % (n, e)
     # Caculate bbox including edge for kernel
     bbox = (e * 1000 - 0.8, n * 1000 - 0.8, e * 1000 + 1000.8, n * 1000 + 1000.8)
     for d in ["Amplitude", "Pulsewidth", "ndvi"]:
-        if (out_dir / ("%s_%s_mean.tif" % (kvnet, d))).exists():
+        srcfile = out_dir / ("%s.vrt" % d)
+        if not needs_rebuild(out_dir / ("%s_%s_mean.tif" % (kvnet, d)), [srcfile]):
             print("Existing derived features found for %s_%s. Skipping" % (kvnet, d))
             continue
-        args = ["surfclass", "prepare", "extractfeatures"]
-        args += ["--bbox"] + [str(x) for x in bbox]
-        args += ["-n", "5"]
-        args += ["-c", "crop"]
-        args += ["--prefix", "%s_%s_" % (kvnet, d)]
-        args += ["-f", "mean"]
-        args += ["-f", "var"]
-        args += ["-f", "diffmean"]
-        args += ["%s/%s.vrt" % (out_dir.resolve(), d)]
-        args += [str(out_dir)]
-        print("Running: ", args)
-        subprocess.run(args, check=True)
+        extract_features(kvnet, d, bbox, out_dir)
 
 
 def gdal_vrt_derived(out_dir):
     for d in ("Amplitude", "Pulsewidth", "ndvi"):
         for m in ("mean", "var", "diffmean"):
-            args = ["gdalbuildvrt"]
-            args += ["-resolution", "user"]
-            # Cover entire DK + margin
-            args += ["-tap"]
-            args += ["-tr", "0.4", "0.4"]
-            args += ["-te", "440000", "6048000", "895000", "6404000"]
-            args += [str(out_dir / ("%s_%s.vrt" % (d, m)))]  # Output vrt
-            args += [str(out_dir / ("*_%s_%s.tif" % (d, m)))]  # Input files
-            print("Running: ", args)
-            subprocess.Popen(" ".join(args), shell=True).wait()
+            build_vrt(out_dir, "%s_%s.vrt" % (d, m), "*_%s_%s.tif" % (d, m))
 
 
 def prep_train_data(out_dir):
     dstfile = out_dir / "traindata_diffmean.npz"
-    if dstfile.exists():
+    features = [out_dir / ("%s.vrt" % f) for f in train_features]
+    if not needs_rebuild(dstfile, features + [train_ds]):
         print("Traindata %s exists. Skipping" % dstfile)
         return
     args = ["surfclass", "prepare", "traindata"]
     args += ["--in", train_ds]
     args += ["--inlyr", train_lyr]
     args += ["-a", train_class_attribute]
-    for f in [
-        "Amplitude_diffmean",
-        "Amplitude_mean",
-        "Amplitude_var",
-        "ndvi_diffmean",
-        "ndvi_mean",
-        "ndvi_var",
-        "Pulsewidth_diffmean",
-        "Pulsewidth_mean",
-        "Pulsewidth_var",
-        "ReturnNumber",
-    ]:
-        args += ["-f", out_dir / ("%s.vrt" % f)]
+    for f in features:
+        args += ["-f", f]
     args += [dstfile]
-    print("Running: ", args)
-    subprocess.run(args, check=True)
+    run(args)
 
 
 def train_model(out_dir):
     datafile = out_dir / "traindata_diffmean.npz"
     modelfile = out_dir / "trained_diffmean.model"
-    if modelfile.exists():
+    if not needs_rebuild(modelfile, [datafile]):
         print("Model %s found. Skipping" % modelfile)
         return
     args = ["surfclass", "train", "genericmodel", datafile, modelfile]
-    print("Running: ", args)
-    subprocess.run(args, check=True)
+    run(args)
 
 
 if __name__ == "__main__":
@@ -207,8 +177,7 @@ if __name__ == "__main__":
     process_lidar(tiles, las_dir, out_dir)
     gdal_vrt_lidar(dimensions, out_dir)
 
-    process_ndvi(tiles, orto_dir, out_dir)
-    gdal_vrt_ndvi(out_dir)
+    gdal_vrt_ndvi(tiles, orto_dir, out_dir)
 
     process_derived(tiles, out_dir)
     gdal_vrt_derived(out_dir)
@@ -31,10 +31,10 @@ INSTALL_REQUIRES = [
     "click",
     "click_plugins",
     "gdal>=3",
+    "joblib>=0.14",
     "pdal>=2",
     "scikit-learn",
     "scipy",
-    "scikit-image",
 ]
 
 EXTRAS_REQUIRE = {"dev": ["pytest", "black"]}
@@ -64,17 +64,16 @@ def read(*parts):
 
 
 META_FILE = read(META_PATH)
+# All __*meta*__ strings in META_FILE, parsed in a single pass
+META = dict(re.findall(r"^__(\w+)__ = ['\"]([^'\"]*)['\"]", META_FILE, re.M))
 
 
 def find_meta(meta):
     """
     Extract __*meta*__ from META_FILE.
     """
-    meta_match = re.search(
-        r"^__{meta}__ = ['\"]([^'\"]*)['\"]".format(meta=meta), META_FILE, re.M
-    )
-    if meta_match:
-        return meta_match.group(1)
+    if meta in META:
+        return META[meta]
     raise RuntimeError("Unable to find __{meta}__ string.".format(meta=meta))
 
 
@@ -1,5 +1,5 @@
 """Process LiDAR data into a surface clasified raster."""
-from collections import namedtuple
+from typing import NamedTuple
 
 __version__ = "0.0.1"
 __description__ = "Processes Lidar-Data into a surface classified raster"
@@ -8,4 +8,11 @@ __email__ = "asger@septima.dk"
 __uri__ = "https://github.com/septima/surfclass"
 __license__ = "Licensed under the MIT license"
 
-Bbox = namedtuple("Bbox", ["xmin", "ymin", "xmax", "ymax"])
+
+class Bbox(NamedTuple):
+    """Bounding box in world coordinates (xmin, ymin, xmax, ymax)."""
+
+    xmin: float
+    ymin: float
+    xmax: float
+    ymax: float
@@ -1,9 +1,13 @@
 """Tools for classifying data."""
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from surfclass import rasterio
 
+# Rows of the feature rasters read and stacked at a time by stack_rasters
+STACK_BLOCK_ROWS = 256
 
-def stack_rasters(raster_paths, bbox=None):
+
+def stack_rasters(raster_paths, bbox=None, dtype=None):
     """Convert list of raster paths to arrays and stack them along the 3rd axis.
 
     If a bbox is supplied the whole stack will be read using that bbox, otherwise the
@@ -12,55 +16,91 @@ def stack_rasters(raster_paths, bbox=None):
     Args:
         raster_paths (list of str): List of paths to feature rasters. The order is important.
         bbox (tuple): Bounding Box of form (xmin,ymin,xmax,ymax)
+        dtype (str, optional): Datatype of the stacked features. Defaults to None, meaning a
+            datatype that can hold the values of all rasters.
 
     Returns:
-        np.ma.ndarray: Masked 3D ndarray in the form (x,y,n) where n is the raster band
+        np.ndarray: 2D ndarray in the form (m,n) with the m valid cells and n raster bands
         np.ndarray: inverted mask, used for retrieving indices of valid cells
         tuple: Gdal Geotransform (x_min, pixel_size, 0, y_max, 0, -pixel_size)
         osgeo.osr.SpatialReference: srs Spatial reference system for the output raster (retrived from common srs in raster_paths).
         tuple: _shape, 2D shape of the resulting output array
 
     """
-    features = []
-    _tmp_geotransform = None
-    srs = None
-    _shape = None
+    readers = []
+    windows = []
+    geotransform = None
     for f in raster_paths:
         rr = rasterio.RasterReader(f)
 
-        if bbox is None:
-            bbox = rr.bbox
-
-        nodata = rr.nodata
-        window = rr.bbox_to_pixel_window(bbox)
-        geotransform = rr.window_geotransform(window)
-        srs = rr.srs
-        if _tmp_geotransform is None:
-            _tmp_geotransform = geotransform
-
-        assert np.allclose(
-            _tmp_geotransform, geotransform
-        ), "Features does not stack, geotransformations must be equal for all rasters"
-
-        # Do not mask the raster.
-        array = rr.read_raster(window=window, masked=False)
-        _shape = array.shape
-        # TODO: Continuing issue. Come up with common way to treat this
-        if nodata is not None:
-            array = np.ma.masked_values(array, nodata)
+        if not readers:
+            if bbox is None:
+                bbox = rr.bbox
+            window = rr.bbox_to_pixel_window(bbox)
+            geotransform = rr.window_geotransform(window)
+        elif rr.geotransform == readers[0].geotransform:
+            # Rasters with the same geotransform as the first share its window
+            window = windows[0]
         else:
-            array = np.ma.array(array)
+            # Rasters with another origin (or grid) need their own window
+            window = rr.bbox_to_pixel_window(bbox)
+            assert np.allclose(
+                geotransform, rr.window_geotransform(window)
+            ), "Features does not stack, geotransformations must be equal for all rasters"
+
+        readers.append(rr)
+        windows.append(window)
+
+    # The rasters stack, so they share the spatial reference system. Only parse it once
+    srs = readers[0].srs
 
-        features.append(array)
+    # The rasters are read in blocks of rows. Only the valid cells of each block are kept, so the
+    # full 3D stack of all features is never held in memory.
+    _shape = (windows[0][3], windows[0][2])
+    dtype = dtype or np.result_type(*[rr.dtype for rr in readers])
+    if _shape[0] <= 0 or _shape[1] <= 0:
+        # An empty window has no cells to read
+        valid_features = np.empty((0, len(readers)), dtype=dtype)
+        return (valid_features, np.zeros(0, dtype=bool), geotransform, srs, _shape)
+    valid_columns = [[] for _ in readers]
+    block_masks = []
 
-    # Stack the features along the 3rd axis and reshape to (X,n)
-    stacked_features = np.ma.dstack(features).reshape(-1, len(features))
+    # GDAL releases the GIL while reading, so the rasters are read in parallel. Each reader is
+    # only used by one thread at a time.
+    with ThreadPoolExecutor(max_workers=min(8, len(readers))) as executor:
+        for y0 in range(0, _shape[0], STACK_BLOCK_ROWS):
+            rows = min(STACK_BLOCK_ROWS, _shape[0] - y0)
+            block_windows = [(c, r + y0, cols, rows) for c, r, cols, _ in windows]
+            arrays = list(executor.map(_read_block, readers, block_windows))
+            # Invert the mask to get all valid data points
+            block_mask = np.invert(np.logical_or.reduce([m for _, m in arrays]))
+            block_mask = block_mask.reshape(-1)
+            for columns, (array, _) in zip(valid_columns, arrays):
+                columns.append(array.reshape(-1).compress(block_mask))
+            block_masks.append(block_mask)
 
-    # Invert the mask to get all valid data points
-    logical_or_mask = np.invert(stacked_features.mask.any(axis=1))
+    logical_or_mask = np.concatenate(block_masks)
 
-    # Get the data from the masked array
-    valid_features = stacked_features[logical_or_mask].data
+    # Each row holds all features of a cell, the layout tree classifiers walk the cells in
+    valid_features = np.empty(
+        (np.count_nonzero(logical_or_mask), len(readers)), dtype=dtype
+    )
+    for i, columns in enumerate(valid_columns):
+        np.concatenate(columns, out=valid_features[:, i])
 
     # Return the intersected mask to be able insert nodata after classification
     return (valid_features, logical_or_mask, geotransform, srs, _shape)
+
+
+def _read_block(rr, window):
+    """Reads a window of a raster and a mask marking cells equal to the nodata value."""
+    # Do not mask the raster.
+    array = rr.read_raster(window=window, masked=False)
+    # Same comparison as np.ma.masked_values
+    if rr.nodata is None:
+        mask = np.zeros(array.shape, dtype=bool)
+    elif np.issubdtype(array.dtype, np.floating):
+        mask = np.isclose(array, rr.nodata)
+    else:
+        mask = array == rr.nodata
+    return array, mask
@@ -1,7 +1,9 @@
 """Extract feature using a kernel."""
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import numpy as np
+from scipy import ndimage as nd
 from surfclass import rasterio, Bbox
 
 logger = logging.getLogger(__name__)
@@ -12,6 +14,127 @@ as_strided = np.lib.stride_tricks.as_strided
 # It takes longer to calculate, and removes too much information
 MAX_ALLOWED_NEIGHBORHOOD = 13
 
+# Largest neighborhood summed by adding shifted slices. A slice per row and column of the
+# neighborhood beats a filter pass up to 5x5, the default neighborhood.
+MAX_SHIFTED_SUM_NEIGHBORHOOD = 5
+
+# Rows of output calculated per block. Blocks are calculated in parallel threads.
+STATISTICS_BLOCK_ROWS = 256
+
+
+def window_sum(matrix, neighborhood):
+    """Calculates the sum of every neighborhood x neighborhood window of a x,y matrix.
+
+    A stack of matrices of shape (k,x,y) can be given to sum all of them in one go.
+
+    The box sum is separable. First a rolling sum of neighborhood rows is taken down every column,
+    then a rolling sum of neighborhood columns along every row of that. Up to
+    `MAX_SHIFTED_SUM_NEIGHBORHOOD` the rolling sums add shifted slices, larger neighborhoods use
+    `scipy.ndimage.correlate1d` with weights of ones.
+
+    Args:
+        matrix (np.array): Matrix with 2 dimensions (x,y), or a stack of them (k,x,y).
+        neighborhood (int): Size of neighborhood.
+
+    Returns:
+        np.array: size (x - neighborhood + 1, y - neighborhood + 1), with k first if given.
+
+    """
+    # Each step below streams through memory in order, so there is no reuse for cache blocking to
+    # improve on within one call. Callers split large rasters into row blocks to bound the
+    # temporaries and to sum the blocks in parallel threads, see `STATISTICS_BLOCK_ROWS`.
+    n = neighborhood
+    *stack, rows, cols = matrix.shape
+
+    if n <= MAX_SHIFTED_SUM_NEIGHBORHOOD:
+        column_sums = matrix[..., : rows - n + 1, :].copy()
+        for i in range(1, n):
+            column_sums += matrix[..., i : rows - n + 1 + i, :]
+        sums = column_sums[..., : cols - n + 1].copy()
+        for i in range(1, n):
+            sums += column_sums[..., i : cols - n + 1 + i]
+        return sums
+
+    # Larger neighborhoods use the compiled separable filter of scipy with a row of ones as weights.
+    # It sums exactly like the slices above, without a pass over the array per row and column.
+    weights = np.ones(n)
+    sums = nd.correlate1d(matrix, weights, axis=-2, mode="constant")
+    nd.correlate1d(sums, weights, axis=-1, mode="constant", output=sums)
+    # The filter centers the window on each cell, keep the cells with whole windows
+    half = n // 2
+    return sums[..., half : half + rows - n + 1, half : half + cols - n + 1]
+
+
+def pad_into(out, matrix, pad_width, mode):
+    """Writes a x,y matrix padded with pad_width cells on each side into out.
+
+    Same result as `out[...] = np.pad(matrix, pad_width, mode=mode)`. For the modes that only repeat
+    cells of the matrix (reflect, symmetric, edge and wrap) no padded copy is made, the matrix is
+    written to the inside of out and the edges are filled from there.
+
+    Args:
+        out (np.array): Output with 2 dimensions (x + 2 * pad_width, y + 2 * pad_width).
+        matrix (np.array): Matrix with 2 dimensions (x,y).
+        pad_width (int): Number of cells to pad on each side.
+        mode (str): Any mode accepted by np.pad, for instance "reflect".
+
+    """
+    p = pad_width
+    if p == 0:
+        out[...] = matrix
+        return
+    if mode not in ("reflect", "symmetric", "edge", "wrap"):
+        out[...] = np.pad(matrix, pad_width, mode=mode)
+        return
+
+    out[p:-p, p:-p] = matrix
+    # Padding the indices of the rows and columns tells where each edge cell is copied from
+    rows = np.pad(np.arange(matrix.shape[0]), p, mode=mode) + p
+    cols = np.pad(np.arange(matrix.shape[1]), p, mode=mode) + p
+    out[:p, p:-p] = out[rows[:p], p:-p]
+    out[-p:, p:-p] = out[rows[-p:], p:-p]
+    out[:, :p] = out[:, cols[:p]]
+    out[:, -p:] = out[:, cols[-p:]]
+
+
+def _block_statistics(values, invalid, neighborhood, mean, var):
+    """Writes the mean and optionally the variance of all neighborhoods of a block of rows.
+
+    Args:
+        values (np.array): Padded rows with nodata set to 0, int64 (summed exactly) or float64.
+        invalid (np.array): Nodata cells of `values`, or None if there are none.
+        neighborhood (int): Size of neighborhood.
+        mean (np.array): float64 output, neighborhood - 1 rows and columns smaller than `values`.
+        var (np.array): float32 output shaped like `mean`, or None to skip the variance. It is
+            calculated in float64 and only rounded when stored.
+
+    """
+    # Sum the values, their squares and the number of valid cells of all neighborhoods in a
+    # single pass over a stack. Nodata cells are left out of the counts instead of masking them.
+    with_var = var is not None
+    with_counts = invalid is not None
+    stack = np.empty((1 + with_var + with_counts,) + values.shape, dtype=values.dtype)
+    stack[0] = values
+    if with_counts:
+        np.logical_not(invalid, out=stack[-1])
+    if with_var:
+        np.multiply(values, values, out=stack[1])
+
+    sums = window_sum(stack, neighborhood)
+    counts = sums[-1] if with_counts else neighborhood ** 2
+
+    # Neighborhoods with nodata only give nan, they always have nodata in the target cell as well
+    with np.errstate(invalid="ignore", divide="ignore"):
+        np.divide(sums[0], counts, out=mean)
+        if with_var and np.issubdtype(values.dtype, np.integer):
+            # n^2 var = n sum(X^2) - sum(X)^2, only rounded in the final division
+            np.divide(counts * sums[1] - sums[0] * sums[0], counts * counts, out=var)
+        elif with_var:
+            # var = E[X^2] - E[X]^2. Clip the small negative values rounding gives in flat areas
+            variance = np.divide(sums[1], counts, out=sums[1])
+            variance -= mean * mean
+            np.maximum(variance, 0, out=var)
+
 
 class KernelFeatureExtraction:
     """Reads raster defined by bbox and extracts features using a kernel with a given neighborhood."""
@@ -43,6 +166,7 @@ class KernelFeatureExtraction:
         bbox=None,
         prefix=None,
         postfix=None,
+        n_workers=None,
     ):
         """Create instance of KernelFeatureExtraction.
 
@@ -55,6 +179,10 @@ class KernelFeatureExtraction:
             crop_mode (str, optional): Crop mode. Defaults to "reflect".
             prefix (str, optional): Prefix to prepend output filename. Defaults to None.
             postfix (str, optional): Postfix to append output filename. Defaults to None.
+            n_workers (int, optional): Maximum number of threads calculating the statistics and
+                writing the features. Defaults to None, meaning the default of
+                `concurrent.futures.ThreadPoolExecutor`. Use 1 when extracting from several
+                threads already.
 
         """
         # str: Path to output directory
@@ -77,6 +205,10 @@ class KernelFeatureExtraction:
         self.crop_mode = crop_mode
         # list of str: list of features to extract (mean|diffmean|mean)
         self.outputfeatures = self._validate_feature_keys(outputfeatures)
+        # int: Maximum number of threads, None for the default of ThreadPoolExecutor
+        self.n_workers = n_workers
+        # tuple: Array, neighborhood and crop_mode of the last calculation and its statistics
+        self._statistics = None
 
     def _output_filename(self, feature_name):
         """Construct the output filename for the calculated tif.
@@ -113,67 +245,143 @@ class KernelFeatureExtraction:
     def calculate_derived_features(self):
         """Calculates the neighborhood statistics for the defined raster and outputfeatures.
 
-        Uses the matrix_as_windows function to generate a vector of length n**2 at each cell to make calculations easier.
+        Uses rolling sums (see `window_sum`) of the raster, its square and its valid cells to get
+        the sums of all neighborhoods in a few array operations, independent of the size of the
+        neighborhood. Nodata cells are left out of the statistics of their neighbors.
+
+        Features of rasters without a nodata value are plain ndarrays, there is nothing to mask.
+        Counting valid cells is skipped as well when the raster has no nodata cells.
+
+        The statistics are kept on the instance, so calculating other features for the same
+        neighborhood and crop_mode afterwards does not sum the neighborhoods again.
 
         Yields:
             tuple(np.ma.array,str): Tuple of the calculated feature and the feature name (mean|diffmean|var)
 
         """
-        # windows is of size (x,y,n**2) 3rd axis is the flattened n-neighborhood of that cell, including the cell itself
-        windows = self.matrix_as_windows(self.array, self.neighborhood, self.crop_mode)
-
-        if self.nodata is not None:
-            mask = self.array == self.nodata
-            masked_values = np.ma.masked_values(windows, self.nodata)
-        else:
-            mask = False
-            masked_values = np.ma.array(windows)
-
-        # Check if cropping has happened, and calculate the size of the removed edge
-        if self.array.shape != masked_values[:, :, 0].shape:
-            edge_size = int((self.neighborhood - 1) / 2)
-        else:
-            edge_size = 0
-
-        # define indices of the inside mask of the new cropped array
-        crop_indices = (
-            slice(edge_size, self.array.shape[0] - edge_size),
-            slice(edge_size, self.array.shape[1] - edge_size),
+        mean, var, mask, center = self._neighborhood_statistics(
+            "var" in self.outputfeatures
         )
 
+        # Every feature gets its own output array, as start() writes them while the next one is
+        # calculated. The mask is shared by all of them.
         for feat_name in self.outputfeatures:
             logger.debug("Calulating %s", feat_name)
+            feature = np.empty(mean.shape, dtype="float32")
             if feat_name == "mean":
-                yield np.ma.masked_array(
-                    np.ma.mean(masked_values, axis=2).astype("float32"),
-                    mask=mask[crop_indices],
-                ), feat_name
+                feature[...] = mean
 
             if feat_name == "diffmean":
-                yield np.ma.masked_array(
-                    (
-                        (
-                            self.array[crop_indices] - np.ma.mean(masked_values, axis=2)
-                        ).astype("float32")
-                    ),
-                    mask=mask[crop_indices],
-                ), feat_name
+                # Subtract in float64 and round once when storing the result
+                np.subtract(
+                    self.array[center],
+                    mean,
+                    out=feature,
+                    dtype="float64",
+                    casting="unsafe",
+                )
 
             if feat_name == "var":
-                yield np.ma.masked_array(
-                    np.ma.var(masked_values, axis=2).astype("float32"),
-                    mask=mask[crop_indices],
-                ), feat_name
+                feature[...] = var
+
+            if self.nodata is not None:
+                feature = np.ma.masked_array(feature, mask=mask)
+            yield feature, feat_name
+
+    def _neighborhood_statistics(self, with_var):
+        """Calculates mean and optionally variance of all neighborhoods, reusing the last result.
+
+        Args:
+            with_var (bool): Calculate the variance as well.
+
+        Returns:
+            tuple: mean, var (None if not calculated), output mask and the target cells of the
+                neighborhoods as a tuple of slices into `self.array`.
+
+        """
+        if self._statistics is not None:
+            array, neighborhood, crop_mode, statistics = self._statistics
+            if (
+                array is self.array
+                and neighborhood == self.neighborhood
+                and crop_mode == self.crop_mode
+                and (statistics[1] is not None or not with_var)
+            ):
+                return statistics
+
+        # Padding is written straight into the stack below, instead of into a padded copy
+        edge_size = (self.neighborhood - 1) // 2
+        pad_width = 0 if self.crop_mode == "crop" else edge_size
+        padded_shape = tuple(size + 2 * pad_width for size in self.array.shape)
+
+        # The target cells of the neighborhoods. Without padding the edge is cropped away
+        crop_size = edge_size - pad_width
+        center = (
+            slice(crop_size, self.array.shape[0] - crop_size),
+            slice(crop_size, self.array.shape[1] - crop_size),
+        )
+
+        # Nodata is set to 0 and left out of the statistics. The output mask is derived once from
+        # the target cells. 8 and 16 bit integer rasters are summed exactly in int64, without
+        # overflow for any allowed neighborhood. Other rasters need float64, float32 sums lose too
+        # many digits when the variance is derived as E[X^2] - E[X]^2.
+        with_counts = self.nodata is not None and (self.array == self.nodata).any()
+        exact = np.issubdtype(self.array.dtype, np.integer)
+        exact = exact and self.array.dtype.itemsize <= 2
+        values = np.empty(padded_shape, dtype="int64" if exact else "float64")
+        pad_into(values, self.array, pad_width, self.crop_mode)
+        mask = np.ma.nomask
+        invalid = None
+        if with_counts:
+            invalid = values == self.nodata
+            values[invalid] = 0
+            rows, cols = padded_shape
+            mask = invalid[edge_size : rows - edge_size, edge_size : cols - edge_size]
+
+        n = self.neighborhood
+        out_rows, out_cols = padded_shape[0] - n + 1, padded_shape[1] - n + 1
+        mean = np.empty((out_rows, out_cols))
+        # The variance is only used as a feature, so it is kept in the float32 of the features.
+        # The mean stays float64, diffmean is subtracted from it before rounding
+        var = np.empty((out_rows, out_cols), dtype="float32") if with_var else None
+
+        # The neighborhoods are local, a block of output rows only needs the n - 1 padded rows
+        # below it as well. numpy and scipy release the GIL, so blocks are calculated in threads
+        # and only the block being summed is expanded into values, squares and counts.
+        def calculate_block(start):
+            stop = min(start + STATISTICS_BLOCK_ROWS, out_rows)
+            rows = slice(start, stop + n - 1)
+            _block_statistics(
+                values[rows],
+                None if invalid is None else invalid[rows],
+                n,
+                mean[start:stop],
+                None if var is None else var[start:stop],
+            )
+
+        blocks = range(0, out_rows, STATISTICS_BLOCK_ROWS)
+        if len(blocks) <= 1 or self.n_workers == 1:
+            for start in blocks:
+                calculate_block(start)
+        else:
+            with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+                list(executor.map(calculate_block, blocks))
+
+        statistics = (mean, var, mask, center)
+        self._statistics = (self.array, self.neighborhood, self.crop_mode, statistics)
+        return statistics
 
     @staticmethod
-    def matrix_as_windows(matrix, neighborhood, crop_mode):
-        """Calculate the "windows" of a x,y matrix with a given neighborhood.
+    def pad_matrix(matrix, neighborhood, crop_mode):
+        """Pads a x,y matrix with half a neighborhood on each side, unless crop_mode is "crop".
 
-        Uses np.lib.stride_tricks.as_strided to get the memory locations of the windows
-        Requires matrix to be an np.array with 2 dimensions (x,y)
+        Args:
+            matrix (np.array): Matrix with 2 dimensions (x,y)
+            neighborhood (int): Size of neighborhood, has to be odd.
+            crop_mode (str): "crop" or any mode accepted by np.pad, for instance "reflect".
 
         Returns:
-            np.array: size (x,y,neighborhood**2).
+            np.array: Padded matrix, or the matrix itself if crop_mode is "crop".
 
         """
         assert neighborhood % 2 == 1, "Neighborhood size has to be odd"
@@ -187,16 +395,31 @@ class KernelFeatureExtraction:
         # can be reflect or other modes accepted by np.pad
         if crop_mode != "crop":
             matrix = np.pad(matrix, pad_width=pad_width, mode=crop_mode)
+        return matrix
+
+    @staticmethod
+    def matrix_as_windows(matrix, neighborhood, crop_mode):
+        """Calculate the "windows" of a x,y matrix with a given neighborhood.
+
+        Uses np.lib.stride_tricks.as_strided to get the memory locations of the windows
+        Requires matrix to be an np.array with 2 dimensions (x,y)
+
+        The windows are a read-only view of the (padded) matrix, nothing is copied. Reduce them
+        over axis=(2, 3), reshaping the view to (x,y,neighborhood**2) would copy every window.
+
+        Returns:
+            np.array: size (x,y,neighborhood,neighborhood).
 
-        m_shape = matrix.shape
+        """
+        matrix = KernelFeatureExtraction.pad_matrix(matrix, neighborhood, crop_mode)
 
         # Stride magic
-        # returns the indices of all cells as numpy memory locations for the neighborhood as a flattened vector like so:
+        # returns the indices of all cells as numpy memory locations for the neighborhood like so:
         # [1 2 3
         #  4 x 6
-        #  7 8 9] = [1 2 3 4 x 6 7 8 9]
+        #  7 8 9]
         # Where x is the cell being indexed
-        matrix_windows = as_strided(
+        return as_strided(
             matrix,
             shape=(
                 matrix.shape[0] - neighborhood + 1,
@@ -213,32 +436,51 @@ class KernelFeatureExtraction:
             writeable=False,  # Use this to avoid writing to memory in weird places
         )
 
-        return matrix_windows.reshape(
-            m_shape[0] - neighborhood + 1,
-            m_shape[1] - neighborhood + 1,
-            neighborhood ** 2,
-        )
+    def start(self, multiband=False):
+        """Calculate features and write to disk.
 
-    def start(self):
-        """Calculate features and write to disk."""
+        Args:
+            multiband (bool, optional): Write all features as bands of a single file named
+                "{prefix}features{postfix}.tif" instead of a file per feature. The bands are
+                described by the feature names. Defaults to False.
+
+        """
         # Figure out the new origin based on crop_mode and neighborhood
         # If there is no crop, origin is simply UL
         logger.debug("KernelFeatureExtraction started in %s mode", self.crop_mode)
 
-        if self.crop_mode == "crop":
-            crop_amount = (
-                int((self.neighborhood - 1) / 2) * self.rasterreader.resolution
-            )
-            origin = (self.bbox.xmin + crop_amount, self.bbox.ymax - crop_amount)
-        else:
-            origin = (self.bbox.xmin, self.bbox.ymax)
+        edge_size = (self.neighborhood - 1) // 2 if self.crop_mode == "crop" else 0
+        crop_amount = edge_size * self.rasterreader.resolution
+        origin = (self.bbox.xmin + crop_amount, self.bbox.ymax - crop_amount)
 
-        for _, feature in enumerate(self.calculate_derived_features()):
-            outfile = self._output_filename(feature[1])
-            rasterio.write_to_file(
-                outfile,
-                feature[0],  # Array
+        if multiband:
+            arrays, names = zip(*self.calculate_derived_features())
+            rasterio.write_multiband(
+                self._output_filename("features"),
+                arrays,
+                names,
                 origin,
                 self.rasterreader.resolution,
                 self.rasterreader.srs,
             )
+            return
+
+        # GDAL releases the GIL while compressing and writing, so the features are written in
+        # parallel while the next one is calculated
+        workers = max(1, len(self.outputfeatures))
+        if self.n_workers is not None:
+            workers = min(workers, self.n_workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    rasterio.write_to_file,
+                    self._output_filename(feature[1]),
+                    feature[0],  # Array
+                    origin,
+                    self.rasterreader.resolution,
+                    self.rasterreader.srs,
+                )
+                for feature in self.calculate_derived_features()
+            ]
+            for future in futures:
+                future.result()
@@ -1,6 +1,8 @@
 """Tool functions for LiDAR data."""
 import logging
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pdal
 from pdal.pipeline import Pipeline
 import numpy as np
@@ -19,7 +21,20 @@ def open_pdal_pipeline(lidar_file):
 
 
 def read_into_numpy(pdal_pipeline):
-    """Read PDAL pipeline into a numpy array."""
+    """Read PDAL pipeline into a numpy array.
+
+    If the pipeline outputs several arrays they are concatenated into one.
+
+    Args:
+        pdal_pipeline (pdal.pipeline.Pipeline): Pipeline to read, executed if not already.
+
+    Raises:
+        TypeError: If `pdal_pipeline` is not a PDAL pipeline.
+
+    Returns:
+        ndarray: Structured array of lidar points.
+
+    """
     if not isinstance(pdal_pipeline, Pipeline):
         raise TypeError("pdal_pipeline must be of type 'pdal.pipeline.Pipeline'")
     if not pdal_pipeline.arrays:
@@ -28,7 +43,91 @@ def read_into_numpy(pdal_pipeline):
         logger.debug("Pipeline returned: %d", count)
 
     logger.info("Pipeline metadata: \n %s", pdal_pipeline.metadata)
-    return pdal_pipeline.arrays
+    arrays = pdal_pipeline.arrays
+    if len(arrays) == 1:
+        return arrays[0]
+    # Copy each array once into its place in the output
+    points = np.empty(sum(len(a) for a in arrays), dtype=arrays[0].dtype)
+    offset = 0
+    for a in arrays:
+        points[offset : offset + len(a)] = a
+        offset += len(a)
+    return points
+
+
+def read_files(lidar_files, max_workers=None):
+    """Reads LiDAR files into numpy arrays, several files at a time.
+
+    Each file is read by its own PDAL pipeline in a thread. The reading happens in PDAL's C++ code,
+    so files are read in parallel, and the points of one file can be processed while the others
+    are still being read.
+
+    Args:
+        lidar_files (list of str): List of paths to LiDAR files.
+        max_workers (int, optional): Maximum number of files read at a time. Defaults to None,
+            meaning the default of `concurrent.futures.ThreadPoolExecutor`.
+
+    Yields:
+        tuple(str, ndarray): Path to each file and its points, in the order reading completes.
+
+    """
+
+    def read(lidar_file):
+        return lidar_file, read_into_numpy(open_pdal_pipeline(lidar_file))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(read, lidar_file) for lidar_file in lidar_files]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def prefetch(lidar_files):
+    """Asks the operating system to start reading LiDAR files into the page cache.
+
+    Returns at once. The files are read ahead in the background while PDAL opens and reads them
+    one by one, so the reads of later files overlap the processing of earlier ones. Does nothing
+    where `os.posix_fadvise` is not available, for instance on Windows. Missing files are ignored.
+
+    Args:
+        lidar_files (list of str): List of paths to LiDAR files.
+
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for lidar_file in lidar_files:
+        try:
+            fd = os.open(lidar_file, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def to_columns(lidar_points, dimensions=None, keep=None):
+    """Splits a structured array of lidar points into one contiguous array per dimension.
+
+    PDAL returns points as a structured array, where reading a single dimension strides through
+    the entire point record. Converting once to contiguous arrays makes the repeated per dimension
+    passes of gridding read only the bytes they need.
+
+    Args:
+        lidar_points (ndarray): Numpy array of lidar points as output from PDAL.
+        dimensions (list of str, optional): Dimensions to keep. Defaults to None, meaning all.
+        keep (ndarray, optional): Boolean array marking the points to keep. Points are selected
+            while each dimension is copied, without a filtered copy of the whole point records.
+            Defaults to None, meaning all points.
+
+    Returns:
+        dict: Contiguous ndarray per dimension name. Datatypes are kept.
+
+    """
+    if dimensions is None:
+        dimensions = lidar_points.dtype.names
+    if keep is not None:
+        return {dim: np.compress(keep, lidar_points[dim]) for dim in dimensions}
+    return {dim: np.ascontiguousarray(lidar_points[dim]) for dim in dimensions}
 
 
 class GridSampler:
@@ -50,17 +149,21 @@ class GridSampler:
         `crop_to_bbox()` before calling `make_grid()`.
 
         Args:
-            lidar_points (ndarray): Numpy array of lidar points as output from PDAL.
+            lidar_points (ndarray or dict): Numpy array of lidar points as output from PDAL or
+                a dict of arrays per dimension as returned by `to_columns`.
             bbox (Bbox): Sampling grid bounding box.
             resolution (float): Sampling grid cell size (cells are square).
 
         """
+        if not isinstance(lidar_points, dict):
+            lidar_points = to_columns(lidar_points)
         self._points = lidar_points
         self._bbox = bbox
         self._resolution = resolution
         self._grid_shape = self._calc_grid_shape()
         self._prepared = False
         self._cell_indexes = None
+        self._cell_points = None
 
         #: bool: Select points with the lowest possible absolute `ScanAngleRank`.
         self.use_min_scanangle = True
@@ -75,39 +178,66 @@ class GridSampler:
 
         """
         xmin, ymin, xmax, ymax = self._bbox
-        maskx = np.logical_and(self._points["X"] >= xmin, self._points[:]["X"] < xmax)
-        masky = np.logical_and(self._points["Y"] > ymin, self._points[:]["Y"] <= ymax)
-        mask = np.logical_and(maskx, masky)
-        self._points = self._points[mask]
+        x, y = self._points["X"], self._points["Y"]
+        # Accumulate the mask in place, reusing one buffer for the comparisons
+        mask = np.greater_equal(x, xmin)
+        test = np.less(x, xmax)
+        mask &= test
+        mask &= np.greater(y, ymin, out=test)
+        mask &= np.less_equal(y, ymax, out=test)
+        if mask.all():
+            # Points are usually cropped by PDAL already. Avoid copying every dimension
+            return
+        self._points = {dim: arr[mask] for dim, arr in self._points.items()}
         self._prepared = False
 
     def _prepare(self):
+        # Find the point sampled by each grid cell. Cells without points get -1
+        rows, cols = self._grid_shape
+        row_ixes, col_ixes = self._calc_cell_indexes()
+        if (
+            row_ixes.min(initial=0) < 0
+            or row_ixes.max(initial=0) >= rows
+            or col_ixes.min(initial=0) < 0
+            or col_ixes.max(initial=0) >= cols
+        ):
+            raise IndexError("Points outside the grid. Call crop_to_bbox() first")
+        flat_ixes = np.multiply(row_ixes, cols, dtype=np.intp)
+        flat_ixes += col_ixes
+        cell_points = np.full(rows * cols, -1, dtype=np.intp)
+
         if self.use_min_scanangle:
-            # Order points by descending abs(scananglerank)
-            # This eventually gives us the echo with the smallest abs(scananglerank)) for each output cell
-            abs_angle = np.abs(self._points[:]["ScanAngleRank"])
-            # the indices that would sort the abs_angle array
-            sorted_ix_abs_angle = np.argsort(abs_angle)
-            # Sort points by desc abs_angle
-            self._points = self._points[sorted_ix_abs_angle[::-1]]
+            # Select the echo with the smallest abs(scananglerank) for each output cell. The
+            # smallest angle of each cell is found in a single pass, no sorting of the points.
+            abs_angle = np.abs(self._points["ScanAngleRank"]).astype("float64")
+            min_angle = np.full(rows * cols, np.inf)
+            np.minimum.at(min_angle, flat_ixes, abs_angle)
+            is_min = abs_angle == min_angle[flat_ixes]
+            cell_points[flat_ixes[is_min]] = np.flatnonzero(is_min)
+        else:
+            # The last point in a cell wins, as when assigning all points to the grid in order
+            cell_points[flat_ixes] = np.arange(len(flat_ixes))
 
-        # Now calculate cell indexes for the sorted points
-        self._cell_indexes = self._calc_cell_indexes()
+        #: Flat indexes of the grid cells with points and the points sampled for them
+        self._cell_indexes = np.flatnonzero(cell_points >= 0)
+        self._cell_points = cell_points[self._cell_indexes]
+        self._prepared = True
 
     def _calc_cell_indexes(self):
-        # cell row indexes
+        # Cell indexes of a grid fit in int32, half the memory of the default int64
         xmin, _, _, ymax = self._bbox
-        col_ixes = ((self._points[:]["X"] - xmin) / self._resolution).astype(int)
         # cell col indexes
-        row_ixes = ((self._points[:]["Y"] - ymax) / (-1 * self._resolution)).astype(int)
+        col_ixes = ((self._points["X"] - xmin) / self._resolution).astype(np.int32)
+        # cell row indexes
+        row_ixes = ((ymax - self._points["Y"]) / self._resolution).astype(np.int32)
         return (row_ixes, col_ixes)
 
     def _calc_grid_shape(self):
         xmin, ymin, xmax, ymax = self._bbox
         dx, dy = np.abs(xmax - xmin), np.abs(ymax - ymin)
         rows, cols = (
-            np.int(np.round(dy / self._resolution)),
-            np.int(np.round(dx / self._resolution)),
+            int(np.round(dy / self._resolution)),
+            int(np.round(dx / self._resolution)),
         )
         return (rows, cols)
 
@@ -125,7 +255,7 @@ class GridSampler:
             TypeError: If given `nodata` cannot be cast to the output datatype.
 
         Returns:
-            array: 2D ndarray with sampled grid. Masked if requested.
+            array: 2D ndarray with sampled grid. Cells without points are masked if requested.
 
         """
         if not self._prepared:
@@ -133,13 +263,13 @@ class GridSampler:
         if not isinstance(dimension, str):
             raise TypeError("dimension must be a string")
 
-        if not dimension in self._points.dtype.fields:
-            valid_fields = self._points.dtype.fields
+        if not dimension in self._points:
+            valid_fields = list(self._points)
             raise ValueError(
                 f"dimension '{dimension}' not found in data ({valid_fields})"
             )
 
-        datatype = self._points.dtype[dimension]
+        datatype = self._points[dimension].dtype
         if not np.can_cast(nodata, datatype):
             raise TypeError(
                 f"nodata value {nodata} cannot be cast to dimension dtype {datatype}"
@@ -151,15 +281,16 @@ class GridSampler:
             nodata,
             masked,
         )
-        out_grid = np.ones(self._grid_shape, datatype) * nodata
+        out_grid = np.full(self._grid_shape, nodata, datatype)
         logger.info("Gridding dimension %s", dimension)
-        out_grid[self._cell_indexes[0], self._cell_indexes[1]] = self._points[:][
-            dimension
+        # Only gather the values of the sampled points
+        out_grid.reshape(-1)[self._cell_indexes] = self._points[dimension][
+            self._cell_points
         ]
         if not masked:
             return out_grid
         logger.debug("Masking")
-        # TODO: Create mask without using a nodata value.
-        # Create a bool directly from _points where there is a point inside a given cell.
-        mask = out_grid == nodata
+        # Mask the cells without points, not the cells equal to nodata. Points may have that value
+        mask = np.ones(self._grid_shape, dtype=bool)
+        mask.reshape(-1)[self._cell_indexes] = False
         return np.ma.array(out_grid, mask=mask)
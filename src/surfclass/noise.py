@@ -1,7 +1,11 @@
 """Tools for handling noisy output from classification."""
 import numpy as np
 from scipy import ndimage as nd
-from skimage.filters import rank
+from scipy.spatial import cKDTree
+
+# Fill from a KD-tree of the border cells when less than this fraction of the cells is masked.
+# Otherwise a distance transform of the whole array is cheaper.
+MAX_KDTREE_FILL_FRACTION = 0.05
 
 
 def fill_nearest_neighbor(a):
@@ -21,10 +25,39 @@ def fill_nearest_neighbor(a):
         raise TypeError("Input must be masked array")
     if not np.ma.is_masked(a):
         return a
-    indexes = nd.distance_transform_edt(
-        a.mask, return_indices=True, return_distances=False
-    )
-    filled = a.data[tuple(indexes)]
+    return _fill_nearest(a.data, a.mask)
+
+
+def _fill_nearest(data, invalid):
+    """Fills invalid cells with the value from the nearest valid cell.
+
+    When only a few cells are invalid, the nearest valid cells are looked up in a KD-tree of the
+    valid cells bordering invalid cells. The nearest valid cell of an invalid cell always has an
+    invalid neighbor, as the next cell towards the invalid cell is closer. Otherwise the nearest
+    cells are found by a distance transform of the whole array.
+
+    Args:
+        data (ndarray): A 2D array.
+        invalid (ndarray): 2D array of bools, True for the cells to fill. Not all True.
+
+    Returns:
+        ndarray: A 2D array.
+
+    """
+    if invalid.mean() > MAX_KDTREE_FILL_FRACTION:
+        indexes = nd.distance_transform_edt(
+            invalid, return_indices=True, return_distances=False
+        )
+        return data[tuple(indexes)]
+
+    border = nd.binary_dilation(invalid, structure=np.ones((3, 3), dtype=bool))
+    border &= ~invalid
+    border_cells = np.nonzero(border)
+    invalid_cells = np.nonzero(invalid)
+    tree = cKDTree(np.column_stack(border_cells))
+    _, nearest = tree.query(np.column_stack(invalid_cells))
+    filled = data.copy()
+    filled[invalid_cells] = data[border_cells][nearest]
     return filled
 
 
@@ -50,9 +83,12 @@ def sieve(a, min_cluster_size, structure=np.ones((3, 3))):
     if not isinstance(a, np.ma.MaskedArray):
         raise TypeError("Input must be masked array")
     class_values = np.unique(a.compressed())
+    # Masking does not change the data, so the small clusters of all classes are collected first
+    # and masked in one go
+    noise = np.zeros(a.shape, dtype=bool)
     for c in class_values:
-        mask = sieve_mask(a.data, c, min_cluster_size, structure=structure)
-        a[mask] = np.ma.masked
+        noise |= sieve_mask(a.data, c, min_cluster_size, structure=structure)
+    a[noise] = np.ma.masked
 
 
 def sieve_mask(a, class_number, min_cluster_size, structure=np.ones((3, 3))):
@@ -71,17 +107,19 @@ def sieve_mask(a, class_number, min_cluster_size, structure=np.ones((3, 3))):
 
     """
     class_bin = a == class_number
-    labeled_array, _ = nd.measurements.label(class_bin, structure)
+    labeled_array, _ = nd.label(class_bin, structure)
     binc = np.bincount(labeled_array.ravel())
-    noise_idx = np.where(binc < min_cluster_size)
-    shp = a.shape
-    mask = np.in1d(labeled_array, noise_idx).reshape(shp)
-    return mask
+    # Labels are consecutive, so a lookup table per label gives the mask. 0 is not a cluster
+    is_noise = binc < min_cluster_size
+    is_noise[0] = False
+    return is_noise[labeled_array]
 
 
 def majority_vote(a, iterations=1, structure=np.ones((3, 3))):
     """Changes cell values to the most frequent value in its neighborhood.
 
+    Ties go to the lowest value. Cells outside the array are not counted.
+
     Args:
         a (ndarray): 2D ndarray. Possible a MaskedArray.
         iterations (int, optional): Number of times to repeat the process. Defaults to 1.
@@ -95,18 +133,52 @@ def majority_vote(a, iterations=1, structure=np.ones((3, 3))):
     nodata = None
     assert a.dtype == "uint8", "Majority vote only works for uint8"
     if np.ma.is_masked(a):
-        # windowed_histogram does not work with masked arrays
+        # _mode_filter works on plain arrays, so masked cells count as a value of their own
         nodata = np.max(a) + 1
         a = a.filled(nodata)
     for _ in range(iterations):
-        a = rank.windowed_histogram(a, structure).argmax(axis=-1).astype("uint8")
-    return np.ma.masked_values(a, nodata) if nodata is not None else a
+        a = _mode_filter(a, structure)
+    return np.ma.masked_values(a, nodata, copy=False) if nodata is not None else a
+
+
+def _mode_filter(a, structure):
+    """Gets the most frequent value in the neighborhood of each cell.
+
+    The neighborhood is counted for each value present in `a` only, instead of a full histogram of
+    all possible values per cell. The counts of a value are sums of shifted slices of a zero padded
+    array telling where `a` equals that value, one slice per cell in `structure`.
+
+    Args:
+        a (ndarray): 2D ndarray.
+        structure (ndarray): The neighborhood expressed as a 2-D array of 1’s and 0’s.
+
+    Returns:
+        ndarray: 2D ndarray of same dimensions and dtype as input array.
+
+    """
+    footprint = np.asarray(structure) != 0
+    values = np.unique(a)
+    rows, cols = a.shape
+    height, width = footprint.shape
+    dtype = "uint8" if footprint.sum() < 256 else "uint16"
+    # The footprint is centered on each cell like in a scipy.ndimage filter
+    top, left = height // 2, width // 2
+    equal = np.zeros((len(values), rows + height - 1, cols + width - 1), dtype=dtype)
+    np.equal(
+        a, values[:, None, None], out=equal[:, top : top + rows, left : left + cols]
+    )
+    counts = np.zeros((len(values), rows, cols), dtype=dtype)
+    for dy, dx in zip(*np.nonzero(footprint)):
+        counts += equal[:, dy : dy + rows, dx : dx + cols]
+    # argmax returns the first of equal counts, values are sorted
+    return values[counts.argmax(axis=0)]
 
 
 def denoise(a):
     """Applies simple denoising to a classified raster.
 
-    Denoising removes small clusters and fills nodata areas.
+    Denoising removes small clusters and fills nodata areas. Same as `majority_vote` with 2
+    iterations, `fill_nearest_neighbor` and `majority_vote` again, without masking in between.
 
     Args:
         a (MaskedArray): 2D MaskedArray with 'uint8' type
@@ -115,7 +187,21 @@ def denoise(a):
         ndarray: Denoised data
 
     """
-    a = majority_vote(a, 2)
-    a = fill_nearest_neighbor(a)
-    denoised = majority_vote(a, 1)
-    return denoised.filled() if isinstance(denoised, np.ma.MaskedArray) else denoised
+    assert a.dtype == "uint8", "Denoise only works for uint8"
+    structure = np.ones((3, 3))
+    nodata = None
+    if np.ma.is_masked(a):
+        # Nodata takes part in the first votes as a value of its own, like in majority_vote
+        nodata = np.max(a) + 1
+        data = a.filled(nodata)
+    else:
+        data = np.ma.getdata(a)
+
+    for _ in range(2):
+        data = _mode_filter(data, structure)
+
+    if nodata is not None:
+        invalid = data == nodata
+        if invalid.any():
+            data = _fill_nearest(data, invalid)
+    return _mode_filter(data, structure)
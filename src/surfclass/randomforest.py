@@ -1,11 +1,82 @@
 """Classification using random forest."""
+import copy
 import logging
-import pickle
+from concurrent.futures import ThreadPoolExecutor
+import joblib
 import numpy as np
 from sklearn.ensemble import RandomForestClassifier
 
 logger = logging.getLogger(__name__)
 
+# Number of observations classified at a time. Caps the memory of the class probabilities
+CLASSIFY_BLOCK_SIZE = 1 << 18
+
+# Blocks are classified in parallel from this number of blocks. Fewer blocks are classified one
+# at a time, with the trees of each block in parallel
+MIN_PARALLEL_BLOCKS = 3
+
+# Fewer observations than this are classified by a single thread. Starting the jobs would take
+# longer than walking the trees
+MIN_PARALLEL_OBSERVATIONS = 10000
+
+
+def _leaf_classes(model):
+    """Gets the class of the nodes of every tree in a forest where all leaves are pure.
+
+    A leaf is pure when the training observations ending in it all have the same class, as they
+    have for trees grown until `min_samples_leaf=1` without duplicate observations.
+
+    Args:
+        model (sklearn.ensemble.RandomForestClassifier): A trained RandomForestClassifier
+
+    The classes of all trees are packed into one contiguous array, padded to the largest tree,
+    instead of an array per tree object.
+
+    Returns:
+        np.array: Index into `model.classes_` of shape (trees, nodes). None if a leaf is not pure.
+
+    """
+    max_nodes = max(estimator.tree_.node_count for estimator in model.estimators_)
+    dtype = "int16" if len(model.classes_) <= 1 << 15 else "int32"
+    classes = np.zeros((len(model.estimators_), max_nodes), dtype=dtype)
+    for node_class, estimator in zip(classes, model.estimators_):
+        tree = estimator.tree_
+        value = tree.value[:, 0, :]
+        leaves = tree.children_left == -1
+        if np.any(np.count_nonzero(value[leaves], axis=1) != 1):
+            return None
+        node_class[: tree.node_count] = np.argmax(value, axis=1)
+    return classes
+
+
+def _vote(model, leaf_class, X):
+    """Counts the votes of the trees of a forest with pure leaves for each class.
+
+    With pure leaves each tree predicts a probability of 1 for a single class, so
+    `model.predict_proba(X)` equals the votes divided by the number of trees. Instead of a float
+    probability per class and tree, only the leaf of each tree is looked up.
+
+    Args:
+        model (sklearn.ensemble.RandomForestClassifier): A trained RandomForestClassifier
+        leaf_class (np.array): Classes of the nodes of each tree from `_leaf_classes`.
+        X (np.array): 2D Matrix of feature observations.
+
+    Returns:
+        np.array: Votes of shape (observations, classes).
+
+    """
+    # The trees are walked with C contiguous float32, like predict does
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    n_classes = len(model.classes_)
+    dtype = "uint16" if len(model.estimators_) < 1 << 16 else "uint32"
+    votes = np.zeros(X.shape[0] * n_classes, dtype=dtype)
+    offsets = np.arange(0, votes.size, n_classes)
+    for estimator, node_class in zip(model.estimators_, leaf_class):
+        cells = offsets + node_class[estimator.apply(X, check_input=False)]
+        # Each observation gets a single vote per tree, there are no duplicate cells
+        votes[cells] += 1
+    return votes.reshape(X.shape[0], n_classes)
+
 
 class RandomForest:
     """Train or classify using a RandomForest model."""
@@ -21,10 +92,27 @@ class RandomForest:
         """
         self.num_features = num_features
         self.model = self.load_model(model)
+        # tuple: The last classified model and the classes of its nodes, see `_leaf_classes`
+        self._leaf_class = None
+
+    @property
+    def model(self):
+        """sklearn.ensemble.RandomForestClassifier: The model, validated once when it is set."""
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+        self._validated = model is not None and self.validate_model(model) is not None
 
     def load_model(self, model):
         """Load trained sklearn.ensemble.RandomForestClassifier model.
 
+        Models are loaded with joblib, which also loads models saved with `pickle.dump`. The
+        arrays of models saved with `joblib.dump` are read straight into numpy arrays, without a
+        pickled copy of them in between. The trees copy their nodes into memory of their own, so
+        the models are not memory mapped.
+
         Args:
             model_path (str): path to the trained model
 
@@ -37,7 +125,7 @@ class RandomForest:
         # Check if the model_input is a path or an sklearn random forest model
         if isinstance(model, str):
             try:
-                model = pickle.load(open(model, "rb"))
+                model = joblib.load(model)
                 return self.validate_model(model)
             except OSError:
                 logger.error("Could not load RandomForestModel")
@@ -49,6 +137,21 @@ class RandomForest:
 
         return None
 
+    def save_model(self, path, compress=0):
+        """Save the model with joblib.
+
+        Compressed models are smaller on disk and faster to read from slow or network storage, but
+        are decompressed when loaded. Uncompressed models load fastest from local disk.
+
+        Args:
+            path (str): Path to write the model to.
+            compress (int, optional): zlib compression level from 0 to 9. Defaults to 0, meaning
+                uncompressed.
+
+        """
+        assert self.model is not None, "There is no model to save"
+        joblib.dump(self.model, path, compress=compress)
+
     def validate_model(self, model):
         """Validate a model with the current class instantiation.
 
@@ -82,7 +185,7 @@ class RandomForest:
             X (np.array): 2D Matrix of feature observations.
             y (np.array): 1D vector of class labels.
             num_tress (int): Number of tress used in the forest.
-            processors (int): Number of parallel jobs used to train, -1 means all processors.
+            processors (int): Number of parallel jobs used to train, -1 means all physical cores.
 
         Returns:
             sklearn.ensemble.RandomForestClassifier: A trained RandomForestClassifier model.
@@ -108,6 +211,12 @@ class RandomForest:
             X.shape[0] == y.shape[0]
         ), "Number of class observations does not match number of feature observations."
 
+        if processors == -1:
+            # Hyperthreads share the units the split search runs on, one job per physical core
+            # trains faster than one per logical processor
+            processors = joblib.cpu_count(only_physical_cores=True)
+        logger.debug("Training with %s parallel jobs", processors)
+
         rf = RandomForestClassifier(
             n_estimators=num_trees, oob_score=False, verbose=0, n_jobs=processors
         )
@@ -137,11 +246,18 @@ class RandomForest:
             self.model is not None
         ), "Could not find a model, please either train a model or initialise the class with a valid model path"
 
-        # TODO: This might be double-work but the model attribute can have been changed
-        model = self.validate_model(self.model)
+        # The model is validated when it is set
+        assert self._validated, "The model does not match the number of features"
+        model = self.model
 
-        if isinstance(processors, int):
-            model.n_jobs = processors
+        n_jobs = processors if isinstance(processors, int) else model.n_jobs
+        if X.shape[0] < MIN_PARALLEL_OBSERVATIONS:
+            logger.debug(
+                "Classifying %d observations with one thread instead of n_jobs=%s",
+                X.shape[0],
+                n_jobs,
+            )
+            n_jobs = 1
 
         # Test the X input is acceptable for the given model.
         assert (
@@ -155,11 +271,65 @@ class RandomForest:
         # run the classificaiton using X
         classes = self.model.classes_
 
-        class_prediction_prob = model.predict_proba(X)
-        class_prediction = classes[np.argmax(class_prediction_prob, axis=1)]
+        # Classify blocks of observations into preallocated outputs. The probabilities of all
+        # classes are only held for the blocks being classified
+        class_prediction = np.empty(X.shape[0], dtype=classes.dtype)
+        max_prob = np.empty(X.shape[0]) if prob else None
+        blocks = [
+            slice(start, start + CLASSIFY_BLOCK_SIZE)
+            for start in range(0, X.shape[0], CLASSIFY_BLOCK_SIZE)
+        ]
+
+        # sklearn releases the GIL while walking the trees, so blocks are classified in threads.
+        # Each block then uses a single thread, not another thread per tree.
+        workers = min(joblib.effective_n_jobs(n_jobs), len(blocks))
+        if len(blocks) < MIN_PARALLEL_BLOCKS:
+            workers = 1
+        # A shallow copy shares the trees, only n_jobs differs
+        block_model = copy.copy(model)
+        block_model.n_jobs = 1 if workers > 1 else n_jobs
+
+        # Blocks classified by one thread count the votes of trees with pure leaves, instead of
+        # averaging a probability per tree and class. The result is the same, the probabilities
+        # are the votes divided by the number of trees
+        leaf_class = None
+        if joblib.effective_n_jobs(block_model.n_jobs) == 1:
+            leaf_class = self._node_classes(model)
+
+        def classify_block(block):
+            # sklearn walks the trees with C contiguous float32 observations. Blocks of such X are
+            # views, other blocks are converted here, one block at a time
+            X_block = np.ascontiguousarray(X[block], dtype=np.float32)
+            if leaf_class is not None:
+                votes = _vote(model, leaf_class, X_block)
+                best = np.argmax(votes, axis=1)
+                class_prediction[block] = classes[best]
+                if prob:
+                    max_votes = np.take_along_axis(votes, best[:, None], axis=1)[:, 0]
+                    max_prob[block] = max_votes / len(model.estimators_)
+                return
+            if not prob:
+                class_prediction[block] = block_model.predict(X_block)
+                return
+            class_prediction_prob = block_model.predict_proba(X_block)
+            # The highest probability is taken at the argmax instead of in another full pass
+            best = np.argmax(class_prediction_prob, axis=1)
+            class_prediction[block] = classes[best]
+            max_prob[block] = np.take_along_axis(
+                class_prediction_prob, best[:, None], axis=1
+            )[:, 0]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(classify_block, blocks))
 
         # return tuple with class prediction and highest class probability if prob
         if prob:
-            return (class_prediction, np.amax(class_prediction_prob, axis=1))
+            return (class_prediction, max_prob)
 
         return class_prediction
+
+    def _node_classes(self, model):
+        """Gets `_leaf_classes` of the model, computed once per model."""
+        if self._leaf_class is None or self._leaf_class[0] is not model:
+            self._leaf_class = (model, _leaf_classes(model))
+        return self._leaf_class[1]
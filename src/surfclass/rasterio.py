@@ -1,14 +1,41 @@
 """IO for raster files."""
 # pylint: disable=R0916
 import logging
-from osgeo import gdal, ogr, osr
+from osgeo import gdal, gdal_array, ogr, osr
 import numpy as np
 from surfclass import Bbox
 
 logger = logging.getLogger(__name__)
 
-gdal_int_options = ["TILED=YES", "COMPRESS=deflate"]
-gdal_float_options = ["TILED=YES", "COMPRESS=deflate"]
+# Use ZSTD when the GDAL build supports it. It compresses about as well as deflate at a fraction of the time
+gdal_compress = (
+    "ZSTD"
+    if "ZSTD"
+    in (gdal.GetDriverByName("GTiff").GetMetadataItem("DMD_CREATIONOPTIONLIST") or "")
+    else "DEFLATE"
+)
+# Horizontal differencing (2) for integers and floating point prediction (3) for floats. Blocks
+# only holding nodata are not written at all.
+gdal_common_options = [
+    "TILED=YES",
+    f"COMPRESS={gdal_compress}",
+    "BIGTIFF=IF_SAFER",
+    "SPARSE_OK=TRUE",
+    "NUM_THREADS=ALL_CPUS",
+]
+gdal_int_options = gdal_common_options + ["PREDICTOR=2"]
+gdal_float_options = gdal_common_options + ["PREDICTOR=3"]
+
+# Rows written at a time when masked cells are replaced by the nodata value
+WRITE_BLOCK_ROWS = 256
+
+# Polygons are filled with numpy when their rows times edges are at most this. Larger polygons are
+# rasterized by GDAL, which does not hold an intersection per row and edge in memory
+MAX_SCANLINE_FILL_SIZE = 1 << 20
+
+# MaskedRasterReader.read_many groups geometries in tiles of this many pixels squared, and reads
+# and rasterizes a window per tile
+READ_MANY_TILE_SIZE = 1024
 
 
 class RasterReader:
@@ -31,8 +58,15 @@ class RasterReader:
         self.geotransform = self._ds.GetGeoTransform()
         #: float: Cell size in srs units.
         self.resolution = self.geotransform[1]
+        # (originX, pixel_width, originY, pixel_height) used for every pixel window calculated
+        gt = self.geotransform
+        self._window_transform = (gt[0], gt[1], gt[3], gt[5])
         #: float, None: Raster value indicating nodata cells.
         self.nodata = self._band.GetNoDataValue()
+        #: numpy.dtype: Datatype of the arrays read.
+        self.dtype = np.dtype(
+            gdal_array.GDALTypeCodeToNumericTypeCode(self._band.DataType)
+        )
         #: int: Raster width in cells.
         self.width = self._ds.RasterXSize
         #: int: Raster height in cells.
@@ -93,7 +127,7 @@ class RasterReader:
 
         """
         xmin, ymin, xmax, ymax = bbox
-        originX, pixel_width, _, originY, _, pixel_height = self.geotransform
+        originX, pixel_width, originY, pixel_height = self._window_transform
         x1 = (xmin - originX) / pixel_width
         x2 = (xmax - originX) / pixel_width
         y1 = (ymax - originY) / pixel_height
@@ -126,7 +160,7 @@ class RasterReader:
             self.geotransform[5],
         )
 
-    def read_raster(self, window=None, bbox=None, masked=False):
+    def read_raster(self, window=None, bbox=None, masked=False, out=None):
         """Read (part of) raster and return as masked or raw numpy array.
 
         Reads entire raster if neither bbox nor window is given.
@@ -139,6 +173,9 @@ class RasterReader:
             bbox (Bbox, optional): Part of raster to read expressed in world coordinates
                 (xmin, ymin, xmax, ymax). Defaults to None.
             masked (bool, optional): Return a MaskedArray masked by the raster nodatavalue. Defaults to False.
+            out (ndarray, optional): 2D ndarray at least the size of the window to read into, for
+                instance a buffer reused for many reads. The returned array is a view of it.
+                Defaults to None, meaning a new array.
 
         Returns:
             ndarray: 2D ndarray (possibly masked)
@@ -171,7 +208,8 @@ class RasterReader:
             raise ValueError(f"Window outside raster requested. Window: {src_offset}")
 
         logger.debug("Reading window: %s", src_offset)
-        src_array = self._band.ReadAsArray(*src_offset)
+        buf_obj = None if out is None else out[:rows, :cols]
+        src_array = self._band.ReadAsArray(*src_offset, buf_obj=buf_obj)
 
         if src_offset[2] <= 0 or src_offset[3] <= 0:
             if masked:
@@ -191,6 +229,19 @@ class RasterReader:
 class MaskedRasterReader(RasterReader):
     """Reads part of a raster defined by a polygon into a 2D MaskedArray with a mask marking cells outside the polygon."""
 
+    def __init__(self, raster_path):
+        """Create instance of MaskedRasterReader.
+
+        Args:
+            raster_path (str): Path to raster file
+
+        """
+        super().__init__(raster_path)
+        # Rasterized geometries and, when the values are not returned as is, raster windows are
+        # read into these buffers. They grow to the largest window read
+        self._burn_buf = np.empty(0, dtype="uint8")
+        self._read_buf = np.empty(0, dtype=self.dtype)
+
     def read_2d(self, geom):
         """Reads part of the raster into a 2D MaskedArray with a mask marking cells outside the polygon.
 
@@ -209,6 +260,29 @@ class MaskedRasterReader(RasterReader):
         Returns:
             [numpy.ma.maskedArray]: A masked array where cells outside the geometry are masked.
 
+        """
+        src_array, burned = self._read_burned(geom)
+        if src_array is None:
+            return np.ma.empty(shape=(0, 0))
+
+        # Mask the source data array with our current feature mask. The mask is computed in one
+        # pass into the only new array
+        mask = np.equal(burned, 0)
+        masked = np.ma.MaskedArray(src_array, mask=mask)
+        return masked
+
+    def _read_burned(self, geom, reuse=False):
+        """Reads the window of the raster covering a geometry and rasterizes the geometry into it.
+
+        Args:
+            geom (osgeo.ogr.Geometry): OGR Geometry object
+            reuse (bool, optional): Read the window into a reused buffer. Only for callers which
+                do not keep the window. Defaults to False.
+
+        Returns:
+            tuple: The raster window and a reused uint8 array which is 1 inside the geometry and
+                0 outside. (None, None) if the window is empty.
+
         """
         if not isinstance(geom, ogr.Geometry):
             raise TypeError("Must be OGR geometry")
@@ -217,10 +291,24 @@ class MaskedRasterReader(RasterReader):
         geom_bbox = Bbox(ogr_env[0], ogr_env[2], ogr_env[1], ogr_env[3])
         window = self.bbox_to_pixel_window(geom_bbox)
         if window[2] <= 0 or window[3] <= 0:
-            return np.ma.empty(shape=(0, 0))
-        src_array = self.read_raster(window=window, masked=False)
+            return None, None
+        out = self._reused_buffer("_read_buf", window[3], window[2]) if reuse else None
+        src_array = self.read_raster(window=window, masked=False, out=out)
         # calculate new geotransform of the feature subset
         new_gt = self.window_geotransform(window)
+        rasterized_array = self._reused_buffer("_burn_buf", window[3], window[2])
+
+        # Small polygons in the raster srs are filled directly, without the GDAL datasets
+        polygons = _polygon_rings(geom)
+        geom_srs = geom.GetSpatialReference()
+        if (
+            polygons is not None
+            and window[3] * sum(len(r) for p in polygons for r in p)
+            <= MAX_SCANLINE_FILL_SIZE
+            and (geom_srs is None or geom_srs.IsSame(self.srs))
+        ):
+            _fill_polygons(polygons, new_gt, rasterized_array)
+            return src_array, rasterized_array
 
         # Create a temporary vector layer in memory
         mem_ds = self._ogr_mem_drv.CreateDataSource("out")
@@ -237,11 +325,112 @@ class MaskedRasterReader(RasterReader):
         mem_raster_ds.SetGeoTransform(new_gt)
         # Burn 1 inside our feature
         gdal.RasterizeLayer(mem_raster_ds, [1], mem_layer, burn_values=[1])
-        rasterized_array = mem_raster_ds.ReadAsArray()
+        mem_raster_ds.GetRasterBand(1).ReadAsArray(
+            0, 0, window[2], window[3], buf_obj=rasterized_array
+        )
+        return src_array, rasterized_array
 
-        # Mask the source data array with our current feature mask
-        masked = np.ma.MaskedArray(src_array, mask=np.logical_not(rasterized_array))
-        return masked
+    def read_many(self, geoms):
+        """Reads the parts of the raster covered by several geometries, see `read_2d`.
+
+        The geometries are grouped in tiles of `READ_MANY_TILE_SIZE` pixels by the upper left
+        corner of their windows. The window covering the geometries of a tile is read once, and
+        the geometries are rasterized into it at once. This is faster than `read_2d` per geometry
+        for many geometries close to each other, and far apart geometries do not make one large
+        window.
+
+        Geometries sharing cells with other geometries are read with `read_2d`, so the result
+        is the same as that of `read_2d` for every geometry.
+
+        Args:
+            geoms (list of osgeo.ogr.Geometry): OGR Geometry objects
+
+        Raises:
+            TypeError: If a geometry is not an `osgeo.ogr.Geometry`
+            ValueError: If bbox of a geometry is entirely or partly outside raster coverage.
+
+        Returns:
+            list of numpy.ma.maskedArray: A masked array per geometry, as returned by `read_2d`.
+
+        """
+        windows = []
+        for geom in geoms:
+            if not isinstance(geom, ogr.Geometry):
+                raise TypeError("Must be OGR geometry")
+            ogr_env = geom.GetEnvelope()
+            geom_bbox = Bbox(ogr_env[0], ogr_env[2], ogr_env[1], ogr_env[3])
+            windows.append(self.bbox_to_pixel_window(geom_bbox))
+        arrays = [np.ma.empty(shape=(0, 0)) for _ in windows]
+
+        tiles = {}
+        for i, window in enumerate(windows):
+            if window[2] > 0 and window[3] > 0:
+                tile = (
+                    window[0] // READ_MANY_TILE_SIZE,
+                    window[1] // READ_MANY_TILE_SIZE,
+                )
+                tiles.setdefault(tile, []).append(i)
+        if not tiles:
+            return arrays
+
+        # One temporary vector layer in memory with the geometries numbered from 1
+        mem_ds = self._ogr_mem_drv.CreateDataSource("out")
+        mem_layer = mem_ds.CreateLayer(
+            "mem_lyr", geoms[0].GetSpatialReference(), ogr.wkbUnknown
+        )
+        mem_layer.CreateField(ogr.FieldDefn("id", ogr.OFTInteger))
+        for i, geom in enumerate(geoms, start=1):
+            mem_feature = ogr.Feature(mem_layer.GetLayerDefn())
+            mem_feature.SetGeometry(geom)
+            mem_feature.SetField("id", i)
+            mem_layer.CreateFeature(mem_feature)
+
+        for members in tiles.values():
+            col = min(windows[i][0] for i in members)
+            row = min(windows[i][1] for i in members)
+            cols = max(windows[i][0] + windows[i][2] for i in members) - col
+            rows = max(windows[i][1] + windows[i][3] for i in members) - row
+            tile_window = (col, row, cols, rows)
+            src_array = self.read_raster(window=tile_window, masked=False)
+
+            # Burn the number of each geometry inside it, and count the geometries of each cell
+            mem_raster_ds = self._gdal_mem_drv.Create(
+                "", cols, rows, 2, gdal.GDT_UInt32
+            )
+            mem_raster_ds.SetProjection(self._ds.GetProjection())
+            mem_raster_ds.SetGeoTransform(self.window_geotransform(tile_window))
+            gdal.RasterizeLayer(mem_raster_ds, [1], mem_layer, options=["ATTRIBUTE=id"])
+            gdal.RasterizeLayer(
+                mem_raster_ds,
+                [2],
+                mem_layer,
+                burn_values=[1],
+                options=["MERGE_ALG=ADD"],
+            )
+            ids = mem_raster_ds.GetRasterBand(1).ReadAsArray()
+            counts = mem_raster_ds.GetRasterBand(2).ReadAsArray()
+
+            for i in members:
+                window = windows[i]
+                subset = (
+                    slice(window[1] - row, window[1] - row + window[3]),
+                    slice(window[0] - col, window[0] - col + window[2]),
+                )
+                if counts[subset].max() > 1:
+                    # A cell shared with another geometry only holds the number of one of them
+                    arrays[i] = self.read_2d(geoms[i])
+                else:
+                    mask = np.not_equal(ids[subset], i + 1)
+                    arrays[i] = np.ma.MaskedArray(src_array[subset], mask=mask)
+        return arrays
+
+    def _reused_buffer(self, name, rows, cols):
+        """Gets a C contiguous view of shape (rows, cols) of the grow-only buffer attribute `name`."""
+        buf = getattr(self, name)
+        if buf.size < rows * cols:
+            buf = np.empty(rows * cols, dtype=buf.dtype)
+            setattr(self, name, buf)
+        return buf[: rows * cols].reshape(rows, cols)
 
     def read_flattened(self, geom):
         """Read data within the geom into a 1D masked array.
@@ -260,19 +449,135 @@ class MaskedRasterReader(RasterReader):
             [numpy.ma.maskedArray]: A 1D masked array where cells with `nodata` value are masked.
 
         """
-        # mask marks cells outside geom
-        masked_subset = self.read_2d(geom)
-        # 1D array with cells inside geom only
-        flattened = masked_subset.compressed()
+        # The window is only indexed, so it is read into the reused buffer
+        src_array, burned = self._read_burned(geom, reuse=True)
+        if src_array is None:
+            flattened = np.empty(0)
+        else:
+            # 1D array with cells inside geom only. The burned values are 0 and 1, so they index
+            # as booleans without a MaskedArray in between
+            flattened = src_array[burned.view(bool)]
         # Mark nodata cells as masked
         return (
             np.ma.array(flattened)
             if self.nodata is None
-            else np.ma.masked_values(flattened, self.nodata)
+            else np.ma.masked_values(flattened, self.nodata, copy=False)
         )
 
 
-def write_to_file(filename, array, origin, resolution, srs, nodata=None):
+def _polygon_rings(geom):
+    """Gets the rings of the parts of a polygon or multipolygon as closed (n, 2) point arrays.
+
+    Returns:
+        list of list of ndarray: Per part the exterior ring followed by the interior rings. None
+            if the geometry is not a polygon or multipolygon, or has a ring without points.
+
+    """
+    geom_type = ogr.GT_Flatten(geom.GetGeometryType())
+    if geom_type == ogr.wkbPolygon:
+        parts = [geom]
+    elif geom_type == ogr.wkbMultiPolygon:
+        parts = [geom.GetGeometryRef(i) for i in range(geom.GetGeometryCount())]
+    else:
+        return None
+    polygons = []
+    for part in parts:
+        rings = []
+        for i in range(part.GetGeometryCount()):
+            points = part.GetGeometryRef(i).GetPoints()
+            if not points:
+                return None
+            ring = np.array(points, dtype="float64")[:, :2]
+            if not np.array_equal(ring[0], ring[-1]):
+                ring = np.concatenate([ring, ring[:1]])
+            rings.append(ring)
+        polygons.append(rings)
+    return polygons
+
+
+def _fill_polygons(polygons, geotransform, out):
+    """Burns 1 inside polygons and 0 outside, the same cells as `gdal.RasterizeLayer` burns.
+
+    A cell is inside when its center is. Like GDAL, each row of cell centers is intersected with
+    the edges of all rings, including the first but not the last point of each edge, and the
+    cells between every other pair of sorted intersections are filled. Horizontal exterior edges
+    through a row of centers are filled too.
+
+    Args:
+        polygons (list of list of ndarray): Rings of the polygons, from `_polygon_rings`.
+        geotransform (tuple): Geotransform of `out`.
+        out (ndarray): 2D uint8 array to burn into.
+
+    """
+    rows, cols = out.shape
+    # Pixel coordinates, calculated like GDAL's inverse geotransform does
+    originX, pixel_width, _, originY, _, pixel_height = geotransform
+    inv_x0, inv_dx = -originX / pixel_width, 1.0 / pixel_width
+    inv_y0, inv_dy = -originY / pixel_height, 1.0 / pixel_height
+    rings = [r for p in polygons for r in p]
+    x = [inv_x0 + r[:, 0] * inv_dx for r in rings]
+    y = [inv_y0 + r[:, 1] * inv_dy for r in rings]
+    exterior = np.concatenate(
+        [np.full(len(r) - 1, i == 0) for p in polygons for i, r in enumerate(p)]
+    )
+    x1 = np.concatenate([a[:-1] for a in x])
+    x2 = np.concatenate([a[1:] for a in x])
+    y1 = np.concatenate([a[:-1] for a in y])
+    y2 = np.concatenate([a[1:] for a in y])
+
+    # Horizontal exterior edges on a row of cell centers
+    center_row = y1 - 0.5
+    horizontal = (
+        exterior
+        & (y1 == y2)
+        & (center_row == np.floor(center_row))
+        & (center_row >= 0)
+        & (center_row < rows)
+    )
+    h_rows = center_row[horizontal].astype(np.intp)
+    h_starts = np.clip(np.floor(np.minimum(x1, x2)[horizontal] + 0.5), 0, cols)
+    h_ends = np.clip(np.floor(np.maximum(x1, x2)[horizontal] + 0.5), 0, cols)
+
+    # Edges from low to high y. Each row of centers crosses the edges with y1 <= center < y2
+    swap = y1 > y2
+    x1[swap], x2[swap] = x2[swap], x1[swap].copy()
+    y1[swap], y2[swap] = y2[swap], y1[swap].copy()
+    centers = np.arange(rows)[:, None] + 0.5
+    crosses = (centers >= y1) & (centers < y2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        intersects = (centers - y1) * (x2 - x1) / (y2 - y1) + x1
+    intersects[~crosses] = np.inf
+    intersects.sort(axis=1)
+    n = crosses.sum(axis=1).max(initial=0)
+    starts = np.clip(np.floor(intersects[:, 0:n:2] + 0.5), 0, cols)
+    ends = np.clip(np.floor(intersects[:, 1:n:2] + 0.5), 0, cols)
+    valid = np.isfinite(ends) & (starts < ends)
+    h_valid = h_starts < h_ends
+    row_ixes = np.broadcast_to(np.arange(rows)[:, None], starts.shape)
+    span_rows = np.concatenate([row_ixes[valid], h_rows[h_valid]])
+    starts = np.concatenate([starts[valid], h_starts[h_valid]]).astype(np.intp)
+    ends = np.concatenate([ends[valid], h_ends[h_valid]]).astype(np.intp)
+
+    # Count the spans starting minus ending at each cell, the cells covered have a positive sum
+    size = rows * (cols + 1)
+    span_rows *= cols + 1
+    coverage = np.bincount(span_rows + starts, minlength=size) - np.bincount(
+        span_rows + ends, minlength=size
+    )
+    coverage = np.cumsum(coverage.reshape(rows, cols + 1)[:, :cols], axis=1)
+    np.greater(coverage, 0, out=out, casting="unsafe")
+
+
+def write_to_file(
+    filename,
+    array,
+    origin,
+    resolution,
+    srs,
+    nodata=None,
+    mask=None,
+    num_threads="ALL_CPUS",
+):
     """Writes a georeferenced ndarray to a geotiff file.
 
     This method uses a simple heurestic to choose output datatype. Best results are obtained when the dtype
@@ -286,48 +591,155 @@ def write_to_file(filename, array, origin, resolution, srs, nodata=None):
         srs (int or SpatialReference): Reference system of supplied origin coordinates. Either an EPSG
             code specified as an int or an entire SpatialReference object.
         nodata (number, optional): Pixel value to set as nodatavalue in output raster. Defaults to None.
+        mask (ndarray, optional): 2D boolean ndarray marking cells to write as nodata, as the mask
+            of a MaskedArray does. Defaults to None.
+        num_threads (int or str, optional): Threads GDAL compresses with, see `write_multiband`.
+            Defaults to "ALL_CPUS".
 
     """
-    cols, rows = array.shape[1], array.shape[0]
-    originX, originY = origin
-    dtype = array.dtype
-    gdal_type = dtype_to_gdaltype(dtype)
-    gdal_options = gdaltype_to_creationoptions(gdal_type)
-    geotransform = (originX, resolution, 0, originY, 0, -1 * resolution)
+    write_multiband(
+        filename,
+        [array],
+        None,
+        origin,
+        resolution,
+        srs,
+        nodata=nodata,
+        mask=mask,
+        num_threads=num_threads,
+    )
 
-    driver = gdal.GetDriverByName("GTiff")
-    ds = driver.Create(filename, cols, rows, 1, gdal_type, options=gdal_options)
-    ds.SetGeoTransform(geotransform)
-    band = ds.GetRasterBand(1)
 
-    if nodata is None and np.ma.is_masked(array):
-        nodata = find_nodata_value(array)
+def write_multiband(
+    filename,
+    arrays,
+    band_names,
+    origin,
+    resolution,
+    srs,
+    nodata=None,
+    mask=None,
+    num_threads="ALL_CPUS",
+):
+    """Writes georeferenced ndarrays of the same shape as the bands of one geotiff file.
+
+    The output datatype is chosen from the common dtype of the arrays, as in `write_to_file`. All
+    bands share the nodata value.
+
+    Args:
+        filename (str): Path to write geotiff
+        arrays (list of ndarray): 2D ndarrays optionally MaskedArrays, one per band.
+        band_names (list of str): Band descriptions, one per band. Or None to leave them empty.
+        origin (tuple): World coordinates of upper left corner of upper left pixel (origin_x, origin_y)
+        resolution (float): Pixel size in world coordinate units. Pixel width and height must be equal.
+        srs (int or SpatialReference): Reference system of supplied origin coordinates. Either an EPSG
+            code specified as an int or an entire SpatialReference object.
+        nodata (number, optional): Pixel value to set as nodatavalue in output raster. Defaults to None.
+        mask (ndarray, optional): 2D boolean ndarray marking cells to write as nodata in all bands.
+            Defaults to None.
+        num_threads (int or str, optional): Threads GDAL compresses with, the NUM_THREADS creation
+            option. Defaults to "ALL_CPUS". None compresses in the calling thread, for callers
+            writing several files from threads of their own.
 
-    if nodata is not None:
-        band.SetNoDataValue(nodata)
-        if np.ma.is_masked(array):
-            array = array.filled(fill_value=nodata)
+    """
+    cols, rows = arrays[0].shape[1], arrays[0].shape[0]
+    originX, originY = origin
+    dtype = np.result_type(*arrays)
+    gdal_type = dtype_to_gdaltype(dtype)
+    gdal_options = [
+        o
+        for o in gdaltype_to_creationoptions(gdal_type)
+        if not o.startswith("NUM_THREADS=")
+    ]
+    if num_threads is not None:
+        gdal_options.append(f"NUM_THREADS={num_threads}")
+    if len(arrays) > 1:
+        gdal_options = gdal_options + ["INTERLEAVE=BAND"]
+    geotransform = (originX, resolution, 0, originY, 0, -1 * resolution)
 
     if isinstance(srs, int):
-        epsg_code = srs
-        srs = osr.SpatialReference()
-        srs.ImportFromEPSG(epsg_code)
-    if not isinstance(srs, osr.SpatialReference):
+        wkt = _epsg_wkt(srs)
+    elif isinstance(srs, osr.SpatialReference):
+        wkt = srs.ExportToWkt()
+    else:
         raise ValueError("srs must be either EPSG code or a SpatialReference object")
 
+    if mask is not None and not np.any(mask):
+        mask = None
+    if nodata is None and mask is not None:
+        # The value is looked for in the cells not masked by either mask
+        arrays = [np.ma.array(a, mask=mask | np.ma.getmaskarray(a)) for a in arrays]
+        mask = None
+    if nodata is None and any(np.ma.is_masked(a) for a in arrays):
+        # Only the extremes of the arrays matter when looking for a free value. Bands without
+        # unmasked cells have no extremes, only the sentinels of `_min_max`
+        extremes = [x for a in arrays if np.ma.count(a) > 0 for x in _min_max(a)]
+        nodata = find_nodata_value(np.array(extremes, dtype=dtype))
+
+    driver = gdal.GetDriverByName("GTiff")
+    ds = driver.Create(
+        filename, cols, rows, len(arrays), gdal_type, options=gdal_options
+    )
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(wkt)
+
     logger.debug(
-        "Writing file '%s'. Geotransform: %s. Nodata: %s. Shape: %s",
+        "Writing file '%s'. Geotransform: %s. Nodata: %s. Shape: %s. Bands: %s",
         filename,
         geotransform,
         nodata,
-        array.shape,
+        arrays[0].shape,
+        len(arrays),
     )
-    band.WriteArray(array)
-    ds.SetProjection(srs.ExportToWkt())
-    band.FlushCache()
+    for i, array in enumerate(arrays, start=1):
+        band = ds.GetRasterBand(i)
+        if band_names is not None:
+            band.SetDescription(band_names[i - 1])
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        _write_band(band, array, nodata, mask)
+        band.FlushCache()
     ds = None
 
 
+# WKT of the EPSG codes written, see `_epsg_wkt`
+_epsg_wkt_cache = {}
+
+
+def _epsg_wkt(epsg_code):
+    """Gets the WKT of an EPSG code. Each code is only looked up in the PROJ database once."""
+    wkt = _epsg_wkt_cache.get(epsg_code)
+    if wkt is None:
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(epsg_code)
+        wkt = _epsg_wkt_cache[epsg_code] = srs.ExportToWkt()
+    return wkt
+
+
+def _write_band(band, array, nodata, mask):
+    """Writes an array to a band with masked cells set to nodata.
+
+    Masked cells are replaced in a copy of one block of rows at a time, instead of in a filled
+    copy of the whole array. The C contiguous block buffer is reused for all blocks.
+    """
+    data = np.ma.getdata(array)
+    array_mask = np.ma.getmask(array) if np.ma.is_masked(array) else None
+    if nodata is None or (mask is None and array_mask is None):
+        band.WriteArray(data)
+        return
+    buffer = np.empty(
+        (min(WRITE_BLOCK_ROWS, data.shape[0]), data.shape[1]), dtype=data.dtype
+    )
+    for y0 in range(0, data.shape[0], WRITE_BLOCK_ROWS):
+        rows = slice(y0, y0 + WRITE_BLOCK_ROWS)
+        block = buffer[: min(WRITE_BLOCK_ROWS, data.shape[0] - y0)]
+        np.copyto(block, data[rows])
+        for block_mask in (array_mask, mask):
+            if block_mask is not None:
+                np.putmask(block, block_mask[rows], nodata)
+        band.WriteArray(block, 0, y0)
+
+
 map_dtype_gdal = {
     "uint8": gdal.GDT_Byte,
     "uint16": gdal.GDT_UInt16,
@@ -339,6 +751,14 @@ map_dtype_gdal = {
     "float32": gdal.GDT_Float32,
     "float64": gdal.GDT_Float64,
 }
+# The same mapping keyed by numpy.dtype, so a lookup does not format the dtype as a string
+_gdaltype_by_dtype = {
+    np.dtype(name): gdaltype for name, gdaltype in map_dtype_gdal.items()
+}
+_int_gdaltypes = frozenset(
+    [gdal.GDT_Byte, gdal.GDT_Int16, gdal.GDT_Int32, gdal.GDT_UInt16, gdal.GDT_UInt32]
+)
+_float_gdaltypes = frozenset([gdal.GDT_Float32, gdal.GDT_Float64])
 
 
 def gdaltype_to_creationoptions(gdaltype):
@@ -354,15 +774,9 @@ def gdaltype_to_creationoptions(gdaltype):
         list of str: List of GDAL creation options.
 
     """
-    if gdaltype in [
-        gdal.GDT_Byte,
-        gdal.GDT_Int16,
-        gdal.GDT_Int32,
-        gdal.GDT_UInt16,
-        gdal.GDT_UInt32,
-    ]:
+    if gdaltype in _int_gdaltypes:
         return gdal_int_options
-    if gdaltype in [gdal.GDT_Float32, gdal.GDT_Float64]:
+    if gdaltype in _float_gdaltypes:
         return gdal_float_options
     raise NotImplementedError()
 
@@ -373,12 +787,41 @@ def dtype_to_gdaltype(dtype):
     Args:
         dtype (numpy.dtype): Numpy datatype
 
+    Raises:
+        NotImplementedError: If given numpy datatype is not supported.
+
     Returns:
         int: GDAL datatype value.
 
     """
-    t = str(dtype)
-    return map_dtype_gdal[t]
+    try:
+        return _gdaltype_by_dtype[np.dtype(dtype)]
+    except KeyError:
+        raise NotImplementedError(f"Unsupported datatype: {dtype}") from None
+
+
+# Nodata candidates representable in each datatype, see `_nodata_candidates`
+_nodata_candidates_cache = {}
+
+
+def _nodata_candidates(dtype):
+    """Gets the nines below and above zero which fit strictly inside the range of a datatype.
+
+    The candidates are filtered and cast to the datatype once, so `find_nodata_value` only
+    compares them to the array extremes.
+
+    Returns:
+        tuple of ndarray: Candidates below zero and candidates above zero, in order of preference.
+
+    """
+    candidates = _nodata_candidates_cache.get(dtype)
+    if candidates is None:
+        tinfo = np.finfo(dtype) if dtype.kind == "f" else np.iinfo(dtype)
+        nines = np.array([99, 999, 9999, 99999, 999999, 9999999, 99999999, 999999999])
+        below = -nines[tinfo.min < -nines].astype(dtype)
+        above = nines[nines < tinfo.max].astype(dtype)
+        candidates = _nodata_candidates_cache[dtype] = (below, above)
+    return candidates
 
 
 def find_nodata_value(a):
@@ -391,23 +834,33 @@ def find_nodata_value(a):
         [number]: A number which is not present in the array and which is representable in the array datatype
 
     """
-    amin, amax = np.ma.min(a), np.ma.max(a)
+    amin, amax = _min_max(a)
     t = a.dtype
-    if t.kind == "f":
-        tinfo = np.finfo(t)
-    if t.kind in ("i", "u"):
-        tinfo = np.iinfo(t)
-    nines = [-99, -999, -9999, -99999, -999999, -9999999, -99999999, -999999999]
-    n = next(x for x in nines if tinfo.min < x < amin)
-    if n:
-        return n
+    below, above = _nodata_candidates(t)
+    below = below[below < amin]
+    if below.size:
+        return below[0].item()
     if amin > 0:
         return 0
-    n = next(-x for x in nines if amax < -x < tinfo.max)
-    if n:
-        return n
+    above = above[amax < above]
+    if above.size:
+        return above[0].item()
+    tinfo = np.finfo(t) if t.kind == "f" else np.iinfo(t)
     if tinfo.min < amin:
         return tinfo.min
     if tinfo.max > amax:
         return tinfo.max
     raise Exception("No suitable nodata value found")
+
+
+def _min_max(a):
+    """Gets the min and max of the unmasked values of a, without the filled copies of np.ma."""
+    t = a.dtype
+    tinfo = np.finfo(t) if t.kind == "f" else np.iinfo(t)
+    mask = np.ma.getmask(a)
+    where = True if mask is np.ma.nomask else ~mask
+    data = np.ma.getdata(a)
+    return (
+        np.min(data, where=where, initial=tinfo.max),
+        np.max(data, where=where, initial=tinfo.min),
+    )
@@ -1,6 +1,8 @@
 """Tools for rasterization of LiDAR files."""
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
+import os
 from pathlib import Path
 import pdal
 from surfclass import lidar, rasterio, Bbox
@@ -19,6 +21,19 @@ dimension_nodata = {
     "PointSourceId": 0,
 }
 
+# Names of the dimensions known by PDAL, see `_pdal_dimensions`
+_pdal_dimension_names = None
+
+
+def _pdal_dimensions():
+    """Gets the names of the dimensions known by PDAL, looked up once."""
+    global _pdal_dimension_names  # pylint: disable=global-statement
+    if _pdal_dimension_names is None:
+        _pdal_dimension_names = frozenset(
+            pdaldim["name"] for pdaldim in pdal.dimension.getDimensions()
+        ) | {"Pulse width"}
+    return _pdal_dimension_names
+
 
 class LidarRasterizer:
     """Rasterizes one or more dimensions from one or more LiDAR files.
@@ -55,6 +70,9 @@ class LidarRasterizer:
             prefix (str, optional): Output file(s) prefix. Defaults to None.
             postfix (str, optional): Output file(s) postfix. Defaults to None.
 
+        Raises:
+            ValueError: If a dimension is not recognized by PDAL.
+
         """
         self.lidarfiles = (
             [lidarfiles] if isinstance(lidarfiles, (str, Path)) else list(lidarfiles)
@@ -92,6 +110,9 @@ class LidarRasterizer:
             Exception: If the PDAL pipeline built is not valid.
 
         """
+        # Let the OS read the files ahead while PDAL works through them
+        lidar.prefetch(self.lidarfiles)
+
         # Convert the pipeline to stringified JSON (required by PDAL)
         pipeline_json = json.dumps(self.pipeline)
         pipeline = pdal.Pipeline(pipeline_json)
@@ -105,33 +126,73 @@ class LidarRasterizer:
             raise Exception("Pipeline not valid.")
 
         logger.debug("Reading data")
-        data = pipeline.arrays
-        logger.debug("Data read: %s", data)
-
-        # For now just assume one array
-        points = data[0]
+        points = lidar.read_into_numpy(pipeline)
+        logger.debug("Data read: %s", points)
+        # The pipeline keeps a reference to the point records it returned
+        del pipeline
 
         # For now get rid of PulseWidth==2.55
         logger.warning("Dropping returns with pulsewidth >= 2.55")
-        points = points[points[:]["Pulse width"] < 2.55]
-
+        keep = points["Pulse width"] < 2.55
+
+        # Only the kept points of the dimensions needed for gridding are split into contiguous
+        # arrays. The whole point records are not copied to filter them first
+        columns = dict.fromkeys(["X", "Y", "ScanAngleRank", *self.dimensions])
+        # Rebinding points drops the last reference to the point records, which are freed here.
+        # Only the columns are kept for gridding
+        points = lidar.to_columns(points, columns, keep=keep)
+        del keep
         sampler = lidar.GridSampler(points, self.bbox, self.resolution)
         origin = (self.bbox.xmin, self.bbox.ymax)
-        for dim in self.dimensions:
-            logger.debug("Gridding: %s", dim)
-            nodata = dimension_nodata[dim]
-            outfile = self._output_filename(dim)
-            grid = sampler.make_grid(dim, nodata, masked=False)
-            rasterio.write_to_file(
-                outfile, grid, origin, self.resolution, self.srs, nodata=nodata
-            )
+
+        # GDAL releases the GIL while compressing and writing, so each dimension is written in
+        # parallel while the next one is gridded. GDAL only compresses with threads of its own
+        # when there is one writer, more would oversubscribe the CPUs
+        workers = max(1, min(len(self.dimensions), os.cpu_count() or 1))
+        num_threads = "ALL_CPUS" if workers == 1 else None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for dim in self.dimensions:
+                logger.debug("Gridding: %s", dim)
+                nodata = dimension_nodata[dim]
+                grid = sampler.make_grid(dim, nodata, masked=False)
+                futures.append(
+                    executor.submit(
+                        rasterio.write_to_file,
+                        self._output_filename(dim),
+                        grid,
+                        origin,
+                        self.resolution,
+                        self.srs,
+                        nodata=nodata,
+                        num_threads=num_threads,
+                    )
+                )
+            for future in futures:
+                future.result()
 
     def _create_pipeline(self):
-        # The "merge" filter is not strictly necessary according to https://pdal.io/stages/filters.merge.html#filters-merge
-        # but lets be explicit about it
-        pipeline = list(self.lidarfiles)
+        # xmin and ymax are inclusive, xmax and ymin are inclusive. Otherwise out gridsampler crashes
+        xmin, ymin, xmax, ymax = self.bbox
+        bounds = f"([{xmin}, {xmax - 0.00001}], [{ymin + 0.00001}, {ymax}])"
+
+        # Crop each file right after it is read. When neighbouring files are given to fill a buffer
+        # around the bbox, only the points inside the buffer are kept and merged, not entire files.
+        pipeline = []
+        crop_tags = []
+        for i, lidarfile in enumerate(self.lidarfiles):
+            pipeline.append({"filename": str(lidarfile), "tag": f"reader{i}"})
+            pipeline.append(
+                {
+                    "type": "filters.crop",
+                    "bounds": bounds,
+                    "inputs": [f"reader{i}"],
+                    "tag": f"crop{i}",
+                }
+            )
+            crop_tags.append(f"crop{i}")
 
-        merge = {"type": "filters.merge"}
+        merge = {"type": "filters.merge", "inputs": crop_tags}
         pipeline.append(merge)
         logger.warning("Filtering away everything but ground")
         rangefilter = {
@@ -139,13 +200,6 @@ class LidarRasterizer:
             "limits": "Classification[2:2]",  # Ground classification
         }
         pipeline.append(rangefilter)
-        # xmin and ymax are inclusive, xmax and ymin are inclusive. Otherwise out gridsampler crashes
-        xmin, ymin, xmax, ymax = self.bbox
-        boundsfilter = {
-            "type": "filters.crop",
-            "bounds": f"([{xmin}, {xmax - 0.00001}], [{ymin + 0.00001}, {ymax}])",
-        }
-        pipeline.append(boundsfilter)
 
         # Build the pipeline by concating the reader, filter and writers
         return {"pipeline": pipeline}
@@ -157,17 +211,13 @@ class LidarRasterizer:
 
     @classmethod
     def _validate_dimensions(cls, dimensions):
-        """Validates the dimensions given, against PDAL."""
-        try:
-            for dim in dimensions:
-                if not (
-                    any(
-                        pdaldim["name"] == dim
-                        for pdaldim in pdal.dimension.getDimensions()
-                    )
-                    or dim == "Pulse width"
-                ):
-                    raise ValueError(dim, "Dimension not recognized by PDAL")
-            return dimensions
-        except ValueError as e:
-            print("ValueError: ", e)
+        """Validates the dimensions given, against PDAL.
+
+        Raises:
+            ValueError: If a dimension is not recognized by PDAL.
+
+        """
+        unknown = [dim for dim in dimensions if dim not in _pdal_dimensions()]
+        if unknown:
+            raise ValueError(unknown, "Dimension not recognized by PDAL")
+        return dimensions
@@ -131,7 +131,10 @@ def randomforestndvi(
         feature10,
     ]
 
-    (X, mask, geotransform, srs, _shape) = stack_rasters(features, bbox)
+    # The trees of the model compare features as float32
+    (X, mask, geotransform, srs, _shape) = stack_rasters(
+        features, bbox, dtype="float32"
+    )
     indices = np.where(mask)[0]
     # Instantiate the RandomForest model
     classifier = RandomForest(len(features), model=model)
@@ -148,6 +151,8 @@ def randomforestndvi(
         class_prediction = classifier.classify(X, processors=processors)
 
     logger.debug("Finished classification")
+    # The features are not needed anymore, free them before the outputs are allocated and written
+    del X
 
     classified = np.zeros(mask.shape[0], dtype="uint8")
     # Convert to byte array to save space
@@ -251,7 +256,10 @@ def genericmodel(rasterfiles, model, bbox, processors, prob, output):
     # Read the input rasters and stack them into an np.ndarray
     features = rasterfiles
 
-    (X, mask, geotransform, srs, _shape) = stack_rasters(features, bbox)
+    # The trees of the model compare features as float32
+    (X, mask, geotransform, srs, _shape) = stack_rasters(
+        features, bbox, dtype="float32"
+    )
     indices = np.where(mask)[0]
     # Instantiate the RandomForest model
     classifier = RandomForest(len(features), model=model)
@@ -268,6 +276,8 @@ def genericmodel(rasterfiles, model, bbox, processors, prob, output):
         class_prediction = classifier.classify(X, processors=processors)
 
     logger.debug("Finished classification")
+    # The features are not needed anymore, free them before the outputs are allocated and written
+    del X
 
     classified = np.zeros(mask.shape[0], dtype="uint8")
     # Convert to byte array to save space
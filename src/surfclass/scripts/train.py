@@ -1,6 +1,5 @@
 import logging
 import pathlib
-import pickle
 import click
 from scipy import stats
 from surfclass.randomforest import RandomForest
@@ -35,9 +34,19 @@ def train():
         -2 means using all processors but one, 1 means using only 1 processor. Can't \
         use more processors than there are available cores on the system",
 )
+@click.option(
+    "-c",
+    "--compress",
+    type=click.IntRange(0, 9),
+    required=False,
+    default=0,
+    help="zlib compression level of the model file. 0 means uncompressed. Compression makes the \
+        file smaller and faster to read from slow or network storage, but costs decompression time \
+        when the model is loaded",
+)
 @click.argument("trainingdata", type=click.Path(exists=True, file_okay=True), nargs=1)
 @click.argument("outputfile", type=click.Path(exists=False, file_okay=True), nargs=1)
-def randomforestndvi(trainingdata, outputfile, numtrees, processors):
+def randomforestndvi(trainingdata, outputfile, numtrees, processors, compress):
     r"""Trains a new randomforestndvi model using an .npz file generated by "surfclass prepare traindata [OPTIONS].
 
     The traindata should match the model definition.
@@ -58,11 +67,9 @@ def randomforestndvi(trainingdata, outputfile, numtrees, processors):
     # TODO: Might make sense to generalize the train function, if so pass in features.shape[1] instead of "10"
     classifier = RandomForest(10, model=None)
     logger.debug("Training randomforestndvi")
-    rf_trained = classifier.train(
-        features, classes, num_trees=numtrees, processors=processors
-    )
+    classifier.train(features, classes, num_trees=numtrees, processors=processors)
 
-    pickle.dump(rf_trained, open(outputfile, "wb"))
+    classifier.save_model(outputfile, compress=compress)
     logger.debug(
         "Training done, written .sav to: %s", pathlib.Path(outputfile).resolve()
     )
@@ -89,9 +96,19 @@ def randomforestndvi(trainingdata, outputfile, numtrees, processors):
         -2 means using all processors but one, 1 means using only 1 processor. Can't \
         use more processors than there are available cores on the system",
 )
+@click.option(
+    "-c",
+    "--compress",
+    type=click.IntRange(0, 9),
+    required=False,
+    default=0,
+    help="zlib compression level of the model file. 0 means uncompressed. Compression makes the \
+        file smaller and faster to read from slow or network storage, but costs decompression time \
+        when the model is loaded",
+)
 @click.argument("trainingdata", type=click.Path(exists=True, file_okay=True), nargs=1)
 @click.argument("outputfile", type=click.Path(exists=False, file_okay=True), nargs=1)
-def genericmodel(trainingdata, outputfile, numtrees, processors):
+def genericmodel(trainingdata, outputfile, numtrees, processors, compress):
     r"""Trains a new generic model using an .npz file generated by "surfclass prepare traindata [OPTIONS].
 
     The traindata should match the model definition.
@@ -115,11 +132,9 @@ def genericmodel(trainingdata, outputfile, numtrees, processors):
 
     classifier = RandomForest(features.shape[1], model=None)
     logger.debug("Training Model...")
-    rf_trained = classifier.train(
-        features, classes, num_trees=numtrees, processors=processors
-    )
+    classifier.train(features, classes, num_trees=numtrees, processors=processors)
 
-    pickle.dump(rf_trained, open(outputfile, "wb"))
+    classifier.save_model(outputfile, compress=compress)
     logger.debug(
         "Training done, written .sav to: %s", pathlib.Path(outputfile).resolve()
     )
@@ -0,0 +1,28 @@
+"""Tiles of the Danish 1km kvadratnet."""
+import numpy as np
+
+#: np.dtype: Tile identified by its northing and easting in km, as in the tile name "1km_{n}_{e}".
+TILE_DTYPE = np.dtype([("n", "i4"), ("e", "i4")])
+
+#: ndarray: The 4km x 4km block of sixteen 1km tiles used in the example pipelines.
+#: Eastings 722 to 725, northings 6177 to 6180.
+TILES_4KM = np.array(
+    [(n, e) for e in range(722, 726) for n in range(6177, 6181)], dtype=TILE_DTYPE
+)
+
+
+def bboxes(tiles, res_m=1000):
+    """Calculates the bounding boxes of tiles.
+
+    Args:
+        tiles (ndarray): Array of tiles with `TILE_DTYPE`.
+        res_m (int, optional): Tile size in meters. Defaults to 1000.
+            The lower left corner is always given by the tile name in km.
+
+    Returns:
+        ndarray: (N, 4) array with a bbox (xmin, ymin, xmax, ymax) per tile.
+
+    """
+    xmin = tiles["e"].astype("float64") * 1000
+    ymin = tiles["n"].astype("float64") * 1000
+    return np.stack([xmin, ymin, xmin + res_m, ymin + res_m], axis=1)
@@ -68,14 +68,12 @@ def collect_training_data(poly_dataset, poly_layer, class_attribute, raster_path
         cell_values = [r.read_flattened(ogr_feature.geometry()) for r in raster_readers]
         assert all([len(a) == len(cell_values[0]) for a in cell_values])
         # Get kombined mask of all features
-        mask = np.zeros(cell_values[0].shape)
-        for a in cell_values:
-            mask = np.logical_or(mask, a.mask)
-        # Get only valid (unmasked cells) from all arrays
+        mask = np.logical_or.reduce([np.ma.getmaskarray(a) for a in cell_values])
+        # Get only valid (unmasked cells) from all arrays, straight from the unmasked data
         valid_mask = np.invert(mask)
-        valid_cell_values = [a.data[valid_mask] for a in cell_values]
+        valid_cell_values = [a.data.compress(valid_mask) for a in cell_values]
         # Create array of class_values matching length of feature arrays
-        class_array = np.ones(valid_cell_values[0].shape) * class_value
+        class_array = np.full(valid_cell_values[0].shape, class_value, dtype="float64")
 
         # Append to result
         result_train.append(class_array)
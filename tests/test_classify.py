@@ -0,0 +1,38 @@
+import numpy as np
+from surfclass.classify import stack_rasters
+from surfclass.rasterio import write_to_file
+
+
+def test_stack_rasters_origins(tmp_path):
+    # Each cell holds its row and column in a common grid, so stacked cells must be equal
+    rows, cols = np.mgrid[0:40, 0:60]
+    grid = (rows * 100 + cols + 1).astype("float32")
+    epsg = 25832
+
+    def write(name, row0, col0, shape):
+        path = str(tmp_path / name)
+        data = grid[row0 : row0 + shape[0], col0 : col0 + shape[1]]
+        write_to_file(path, data, (550000 + col0, 6150000 - row0), 1, epsg)
+        return path
+
+    # A raster with another origin placed between two rasters on the first grid
+    rasters = [
+        write("a.tif", 5, 4, (30, 50)),
+        write("b.tif", 2, 1, (38, 58)),
+        write("c.tif", 5, 4, (30, 50)),
+    ]
+    (X, mask, geotransform, _, _shape) = stack_rasters(rasters)
+    assert _shape == (30, 50)
+    assert geotransform == (550004, 1, 0, 6149995, 0, -1)
+    assert X.shape == (1500, 3)
+    assert mask.all()
+    assert (X == grid[5:35, 4:54].reshape(-1, 1)).all()
+
+    # A bbox without rows gives no cells
+    (X, mask, _, _, _shape) = stack_rasters(
+        rasters, bbox=(550004, 6149990, 550010, 6149990)
+    )
+    assert _shape == (0, 6)
+    assert X.shape == (0, 3)
+    assert X.dtype == "float32"
+    assert mask.shape == (0,)
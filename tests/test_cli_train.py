@@ -1,4 +1,4 @@
-import pickle
+import joblib
 from surfclass.train import load_training_data
 from surfclass.scripts.cli import cli
 
@@ -17,7 +17,7 @@ def test_cli_train_genericmodel(cli_runner, tmp_path, genericmodel_traindata_fil
     # Check the file exists
     assert outfile.is_file()
     # Sanity check, load the model and predict some sample data
-    loaded_model = pickle.load(open(outfile, "rb"))
+    loaded_model = joblib.load(outfile)
     (_, classes, features) = load_training_data(genericmodel_traindata_filepath)
     result = loaded_model.predict(features)
 
@@ -1,6 +1,11 @@
 import numpy as np
 from surfclass import Bbox
-from surfclass.kernelfeatureextraction import KernelFeatureExtraction
+from surfclass.kernelfeatureextraction import (
+    KernelFeatureExtraction,
+    pad_into,
+    window_sum,
+)
+from surfclass.rasterio import RasterReader, write_to_file
 
 
 def test_kernelfeatureextraction(amplituderaster_filepath, tmp_path):
@@ -103,3 +108,97 @@ def test_kernelfeatureextraction_nobbox(amplituderaster_filepath, tmp_path):
     # Test DiffMean is correct
     diffmean = extractor.array[112, 112] - extractor.array[110:115, 110:115].mean()
     assert np.float32(diffmean) == derived_features[2][112, 112]
+
+
+def test_window_sum():
+    matrix = np.arange(100, dtype="float64").reshape((10, 10))
+    windows = KernelFeatureExtraction.matrix_as_windows(matrix, 5, "crop")
+    assert windows.shape == (6, 6, 5, 5)
+    assert not windows.flags["OWNDATA"]
+    sums = window_sum(matrix, 5)
+    assert sums.shape == (6, 6)
+    assert np.allclose(sums, windows.sum(axis=(2, 3)))
+
+    # Larger neighborhoods are summed with scipy.ndimage.correlate1d
+    windows = KernelFeatureExtraction.matrix_as_windows(matrix, 7, "reflect")
+    sums = window_sum(np.pad(matrix, 3, mode="reflect"), 7)
+    assert sums.shape == (10, 10)
+    assert np.allclose(sums, windows.sum(axis=(2, 3)))
+
+
+def test_kernelfeatureextraction_integer(tmp_path):
+    data = np.random.default_rng(0).integers(1, 60000, (50, 50)).astype("uint16")
+    data[20:25, 20:25] = 0
+    rasterfile = str(tmp_path / "integer.tif")
+    write_to_file(rasterfile, data, (727000, 6172000), 4, 25832, nodata=0)
+
+    extractor = KernelFeatureExtraction(
+        rasterfile, tmp_path, ["mean", "var"], crop_mode="reflect"
+    )
+    mean, var = [f for f, _ in extractor.calculate_derived_features()]
+    assert mean.dtype == var.dtype == "float32"
+
+    window = data[8:13, 8:13].astype("float64")
+    assert np.float32(window.mean()) == mean[10, 10]
+    assert np.float32(window.var()) == var[10, 10]
+
+    # Nodata is left out of the neighborhood
+    window = data[17:22, 17:22]
+    assert np.float32(window[window != 0].mean()) == mean[19, 19]
+    assert var.mask[22, 22]
+
+
+def test_pad_into():
+    matrix = np.arange(35, dtype="float64").reshape((5, 7))
+    for mode in ["reflect", "symmetric", "edge", "wrap", "constant"]:
+        expected = np.pad(matrix, 2, mode=mode)
+        out = np.empty_like(expected)
+        pad_into(out, matrix, 2, mode)
+        assert np.array_equal(out, expected)
+
+
+def test_kernelfeatureextraction_multiband(amplituderaster_filepath, tmp_path):
+    extractor = KernelFeatureExtraction(
+        amplituderaster_filepath,
+        tmp_path,
+        ["mean", "var", "diffmean"],
+        prefix="test_",
+        crop_mode="crop",
+    )
+    extractor.start(multiband=True)
+
+    reader = RasterReader(str(tmp_path / "test_features.tif"))
+    assert reader.shape == (246, 246)
+    assert reader._ds.RasterCount == 3
+    assert reader._ds.GetRasterBand(3).GetDescription() == "diffmean"
+
+
+def test_kernelfeatureextraction_blocks(
+    amplituderaster_filepath, tmp_path, monkeypatch
+):
+    features = ["mean", "var", "diffmean"]
+    for crop_mode in ["crop", "reflect"]:
+        extractor = KernelFeatureExtraction(
+            amplituderaster_filepath, tmp_path, features, crop_mode=crop_mode
+        )
+        expected = [f for f, _ in extractor.calculate_derived_features()]
+
+        # Blocks that do not divide the rows evenly give the same features
+        monkeypatch.setattr(
+            "surfclass.kernelfeatureextraction.STATISTICS_BLOCK_ROWS", 7
+        )
+        # In parallel threads and in the calling thread
+        for n_workers in [None, 1]:
+            extractor = KernelFeatureExtraction(
+                amplituderaster_filepath,
+                tmp_path,
+                features,
+                crop_mode=crop_mode,
+                n_workers=n_workers,
+            )
+            for (feature, _), exp in zip(
+                extractor.calculate_derived_features(), expected
+            ):
+                assert np.ma.allequal(feature, exp)
+                assert np.array_equal(feature.mask, exp.mask)
+        monkeypatch.undo()
@@ -10,6 +10,26 @@ def test_open_pipeline(las_filepath):
     assert len(pl.arrays[0]) == 16133
 
 
+def test_read_into_numpy(las_filepath):
+    pl = lidar.open_pdal_pipeline(las_filepath)
+    points = lidar.read_into_numpy(pl)
+    assert isinstance(points, np.ndarray)
+    assert len(points) == 16133
+
+
+def test_read_files(las_filepath):
+    results = list(lidar.read_files([las_filepath, las_filepath], max_workers=2))
+    assert len(results) == 2
+    for lidar_file, points in results:
+        assert lidar_file == las_filepath
+        assert len(points) == 16133
+
+
+def test_prefetch(las_filepath, tmp_path):
+    # Prefetching is only a hint, missing files are ignored
+    lidar.prefetch([las_filepath, str(tmp_path / "missing.las")])
+
+
 def test_gridsampler(las_filepath):
     pl = lidar.open_pdal_pipeline(las_filepath)
     pl.execute()
@@ -36,3 +56,74 @@ def test_gridsampler_bbox(las_filepath):
 
     grid = sampler.make_grid("Z", nodata=-999, masked=True)
     assert grid.shape == (2504, 2504)
+
+
+def test_gridsampler_min_scanangle():
+    dtype = np.dtype([("X", "f8"), ("Y", "f8"), ("Z", "f8"), ("ScanAngleRank", "i1")])
+    # Two cells with several points each. Lowest abs(ScanAngleRank) should win regardless of order
+    points = np.array(
+        [
+            (0.5, 1.5, 1.0, -10),
+            (0.2, 1.2, 2.0, 3),
+            (0.7, 1.7, 3.0, -5),
+            (1.5, 1.5, 4.0, 1),
+            (1.2, 1.2, 5.0, -7),
+        ],
+        dtype=dtype,
+    )
+    bbox = (0, 0, 2, 2)
+    sampler = lidar.GridSampler(points, bbox, 1)
+
+    grid = sampler.make_grid("Z", nodata=-999, masked=False)
+    assert np.array_equal(grid, [[2.0, 4.0], [-999, -999]])
+
+    sampler = lidar.GridSampler(points, bbox, 1)
+    sampler.use_min_scanangle = False
+    grid = sampler.make_grid("Z", nodata=-999, masked=False)
+    assert np.array_equal(grid, [[3.0, 5.0], [-999, -999]])
+
+
+def test_to_columns():
+    dtype = np.dtype([("X", "f8"), ("Y", "f8"), ("Intensity", "u2")])
+    points = np.array([(1.5, 2.5, 10), (3.5, 4.5, 20)], dtype=dtype)
+
+    columns = lidar.to_columns(points)
+    assert list(columns) == ["X", "Y", "Intensity"]
+    assert columns["Intensity"].dtype == np.uint16
+    assert columns["X"].flags.c_contiguous
+    assert np.array_equal(columns["Y"], [2.5, 4.5])
+
+    columns = lidar.to_columns(points, ["X", "Y"])
+    assert list(columns) == ["X", "Y"]
+
+    columns = lidar.to_columns(points, ["X", "Intensity"], keep=[False, True])
+    assert np.array_equal(columns["X"], [3.5])
+    assert np.array_equal(columns["Intensity"], [20])
+    assert columns["Intensity"].flags.c_contiguous
+
+
+def test_gridsampler_crop():
+    dtype = np.dtype([("X", "f8"), ("Y", "f8"), ("Z", "f8"), ("ScanAngleRank", "i1")])
+    # xmin and ymax are inclusive, xmax and ymin are exclusive
+    points = np.array(
+        [(0, 2, 1.0, 0), (1.5, 0.5, 2.0, 0), (2, 1, 3.0, 0), (1, 0, 4.0, 0)],
+        dtype=dtype,
+    )
+    sampler = lidar.GridSampler(points, (0, 0, 2, 2), 1)
+    sampler.crop_to_bbox()
+
+    grid = sampler.make_grid("Z", nodata=-999, masked=False)
+    assert np.array_equal(grid, [[1.0, -999], [-999, 2.0]])
+
+
+def test_gridsampler_mask():
+    dtype = np.dtype(
+        [("X", "f8"), ("Y", "f8"), ("Intensity", "u2"), ("ScanAngleRank", "i1")]
+    )
+    points = np.array([(0.5, 1.5, 0, 0), (1.5, 0.5, 7, 0)], dtype=dtype)
+    sampler = lidar.GridSampler(points, (0, 0, 2, 2), 1)
+
+    # A point with the nodata value is not masked, cells without points are
+    grid = sampler.make_grid("Intensity", nodata=0, masked=True)
+    assert np.array_equal(grid.mask, [[False, True], [True, False]])
+    assert np.array_equal(grid.data, [[0, 0], [0, 7]])
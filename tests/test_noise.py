@@ -1,7 +1,13 @@
 from osgeo import gdal
 import numpy as np
 import pytest
-from surfclass.noise import fill_nearest_neighbor, sieve_mask, sieve, majority_vote
+from surfclass.noise import (
+    denoise,
+    fill_nearest_neighbor,
+    sieve_mask,
+    sieve,
+    majority_vote,
+)
 
 
 def read_masked(f):
@@ -19,6 +25,21 @@ def test_fill_nearestneighbor(classraster_filepath):
     assert not np.any(filled == masked_data.fill_value)
 
 
+def test_fill_nearestneighbor_few_masked():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 255, (40, 50)).astype("uint8")
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[[0, 5, 5, 6, 20, 39], [0, 10, 11, 10, 49, 25]] = True
+    filled = fill_nearest_neighbor(np.ma.masked_array(data, mask=mask))
+    np.testing.assert_array_equal(filled[~mask], data[~mask])
+    # Each masked cell gets the value of one of its nearest unmasked cells
+    valid = np.argwhere(~mask)
+    for cell in np.argwhere(mask):
+        distances = np.hypot(*(valid - cell).T)
+        nearest = valid[distances == distances.min()]
+        assert filled[tuple(cell)] in data[tuple(nearest.T)]
+
+
 def test_sieve_mask(classraster_filepath):
     masked_data = read_masked(classraster_filepath)
     mask = sieve_mask(masked_data, 1, 5)
@@ -59,3 +80,14 @@ def test_majority_vote(classraster_filepath):
     int64_data = masked_data.astype("int64")
     with pytest.raises(Exception):
         filtered = majority_vote(int64_data, iterations=5)
+
+
+def test_denoise(classraster_filepath):
+    masked_data = read_masked(classraster_filepath)
+    expected = majority_vote(fill_nearest_neighbor(majority_vote(masked_data, 2)))
+    denoised = denoise(masked_data)
+    assert not isinstance(denoised, np.ma.MaskedArray)
+    np.testing.assert_array_equal(denoised, expected)
+    # Nothing to fill
+    denoised = denoise(np.ma.masked_array(expected))
+    assert denoised.shape == expected.shape
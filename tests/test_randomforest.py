@@ -1,3 +1,4 @@
+import numpy as np
 from surfclass.randomforest import RandomForest
 from surfclass.train import (
     collect_training_data,
@@ -35,3 +36,40 @@ def test_randomforest_train(polygons_filepath, data_dir, tmp_path):
     trained_model = model.train(read_features, read_classes, num_trees=10)
     assert trained_model.n_features_ == num_features
     assert trained_model.n_estimators == 10
+
+
+def test_randomforest_classify_blocks(monkeypatch):
+    rng = np.random.default_rng(0)
+    X = rng.random((1000, 3))
+    y = (X[:, 0] * 3).astype("int64") + 1
+    model = RandomForest(3, model=None)
+    model.train(X, y, num_trees=10)
+    classes, prob = model.classify(X, prob=True)
+    assert np.array_equal(classes, model.classify(X))
+    assert np.array_equal(classes, model.model.predict(X))
+    assert np.array_equal(prob, model.model.predict_proba(X).max(axis=1))
+
+    # Classifying in blocks gives the same result
+    monkeypatch.setattr("surfclass.randomforest.CLASSIFY_BLOCK_SIZE", 128)
+    block_classes, block_prob = model.classify(X, prob=True)
+    assert np.array_equal(classes, block_classes)
+    assert np.array_equal(prob, block_prob)
+    # And in parallel threads
+    monkeypatch.setattr("surfclass.randomforest.MIN_PARALLEL_OBSERVATIONS", 0)
+    block_classes, block_prob = model.classify(X, prob=True, processors=2)
+    assert np.array_equal(classes, block_classes)
+    assert np.array_equal(prob, block_prob)
+
+
+def test_randomforest_save_model(tmp_path):
+    rng = np.random.default_rng(0)
+    X = rng.random((200, 3))
+    y = (X[:, 0] * 3).astype("int64") + 1
+    model = RandomForest(3, model=None)
+    model.train(X, y, num_trees=5)
+    expected = model.classify(X)
+    for compress in (0, 3):
+        outfile = tmp_path / f"model_{compress}.sav"
+        model.save_model(str(outfile), compress=compress)
+        loaded = RandomForest(3, model=str(outfile))
+        assert np.array_equal(loaded.classify(X), expected)
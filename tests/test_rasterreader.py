@@ -52,6 +52,12 @@ def test_rasterreader(classraster_filepath):
     assert int(np.sum(data_window)) == 1591
     assert not np.ma.is_masked(data_window)
     assert int(np.sum(data_window == reader.nodata)) == 154
+    # Read window into a larger buffer
+    out = np.zeros((40, 40), dtype="uint8")
+    out_window = reader.read_raster(window=(23, 51, 27, 29), out=out)
+    assert out_window.shape == (29, 27)
+    assert np.shares_memory(out_window, out)
+    np.testing.assert_array_equal(out_window, data_window)
     # Read bbox masked
     masked_data_window = reader.read_raster(window=(23, 51, 27, 29), masked=True)
     assert masked_data_window.shape == (29, 27)
@@ -121,9 +127,62 @@ def test_maskedrasterreader(classraster_filepath):
     # Check data with mask. (Must be less than unmasked)
     assert int(np.sum(data.compressed())) == 20432
 
+    # A smaller polygon read afterwards does not change the mask of the first
+    small_data = reader.read_2d(pnt.Buffer(20))
+    assert small_data.shape == (20, 20)
+    assert int(np.sum(data.mask)) == 2140
+    assert int(np.sum(small_data.compressed())) < 20432
+
     # Test read_flattened
     flat_data = reader.read_flattened(poly)
     # read_2d returns a 100x100 of which 2140 are outside the poly
     assert flat_data.shape == (100 * 100 - 2140,)
     assert np.ma.is_masked(flat_data)
     assert int(np.ma.sum(flat_data)) == 20432
+
+
+def test_maskedrasterreader_read_many(classraster_filepath, monkeypatch):
+    reader = MaskedRasterReader(classraster_filepath)
+    geoms = []
+    # Two overlapping buffers, and buffers far from each other
+    for x, y, r in [
+        (727500.0, 6171600.0, 100),
+        (727560.0, 6171600.0, 30),
+        (727300.0, 6171400.0, 50),
+        (727900.0, 6171100.0, 20),
+    ]:
+        pnt = ogr.Geometry(ogr.wkbPoint)
+        pnt.AddPoint(x, y)
+        pnt.AssignSpatialReference(reader.srs)
+        geoms.extend([pnt.Buffer(r), pnt])
+    # One tile for all geometries, and a tile per geometry
+    for tile_size in [1024, 8]:
+        monkeypatch.setattr("surfclass.rasterio.READ_MANY_TILE_SIZE", tile_size)
+        arrays = reader.read_many(geoms)
+        assert len(arrays) == len(geoms)
+        for geom, data in zip(geoms, arrays):
+            expected = reader.read_2d(geom)
+            assert data.shape == expected.shape
+            np.testing.assert_array_equal(data.mask, expected.mask)
+            np.testing.assert_array_equal(data.data, expected.data)
+
+
+def test_maskedrasterreader_scanline_fill(classraster_filepath, monkeypatch):
+    reader = MaskedRasterReader(classraster_filepath)
+    # Edges along cell boundaries and through cell centers, and a hole
+    wkt = (
+        "MULTIPOLYGON (((727500 6171600, 727521 6171600, 727531 6171641, 727500 6171631, "
+        "727500 6171600), (727505 6171605, 727515 6171605, 727515 6171615, 727505 6171615, "
+        "727505 6171605)), ((727540 6171601, 727551 6171601, 727545 6171620, 727540 6171601)))"
+    )
+    geoms = [ogr.CreateGeometryFromWkt(wkt)]
+    geoms.append(ogr.CreateGeometryFromWkt("POINT (727500 6171600)").Buffer(33.3))
+    for geom in geoms:
+        geom.AssignSpatialReference(reader.srs)
+        filled = reader.read_2d(geom)
+        # Rasterize with GDAL instead
+        monkeypatch.setattr("surfclass.rasterio.MAX_SCANLINE_FILL_SIZE", 0)
+        rasterized = reader.read_2d(geom)
+        monkeypatch.undo()
+        assert np.any(~filled.mask)
+        np.testing.assert_array_equal(filled.mask, rasterized.mask)
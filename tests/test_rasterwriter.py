@@ -1,6 +1,11 @@
 import os
 import numpy as np
-from surfclass.rasterio import RasterReader, write_to_file
+from surfclass.rasterio import (
+    RasterReader,
+    find_nodata_value,
+    write_multiband,
+    write_to_file,
+)
 
 
 def test_writer(tmp_path):
@@ -75,3 +80,95 @@ def test_writernodata(tmp_path):
     assert read_data.dtype == "float32"
     assert reader.nodata is not None
     assert int(np.sum(reader.read_raster(masked=True).mask)) == 26
+
+
+def test_writer_mask(tmp_path):
+    data = np.arange(1, 1501).astype("float32").reshape((30, 50))
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[10:15, 10:15] = True
+    origin = (550000, 6150000)
+    outfile = os.path.join(tmp_path, "test_writer_mask.tif")
+    write_to_file(outfile, data, origin, 1, 25832, nodata=0, mask=mask)
+    reader = RasterReader(outfile)
+    assert reader.nodata == 0
+    read_data = reader.read_raster(masked=True)
+    assert np.array_equal(read_data.mask, mask)
+    assert np.array_equal(read_data.compressed(), data[~mask])
+    # The written array is not changed
+    assert np.count_nonzero(data == 0) == 0
+
+    # Without a nodata value one is found, as for MaskedArrays
+    masked = np.ma.masked_values(data, 1)
+    write_to_file(outfile, masked, origin, 1, 25832, mask=mask)
+    reader = RasterReader(outfile)
+    assert reader.nodata is not None
+    assert int(np.sum(reader.read_raster(masked=True).mask)) == 26
+
+
+def test_writer_predictor(tmp_path):
+    from osgeo import gdal
+
+    origin = (550000, 6150000)
+    for dtype, predictor in [("uint8", "2"), ("float32", "3")]:
+        data = np.arange(1500).reshape((30, 50)).astype(dtype)
+        outfile = os.path.join(tmp_path, "test_writer_%s.tif" % dtype)
+        write_to_file(outfile, data, origin, 1, 25832)
+        ds = gdal.Open(outfile)
+        assert ds.GetMetadataItem("PREDICTOR", "IMAGE_STRUCTURE") == predictor
+        assert np.array_equal(ds.GetRasterBand(1).ReadAsArray(), data)
+        ds = None
+        # Compressed in the calling thread
+        write_to_file(outfile, data, origin, 1, 25832, num_threads=None)
+        ds = gdal.Open(outfile)
+        assert np.array_equal(ds.GetRasterBand(1).ReadAsArray(), data)
+        ds = None
+
+
+def test_write_multiband(tmp_path):
+    from osgeo import gdal
+
+    mean = np.arange(1500).astype("float32").reshape((30, 50))
+    var = np.ma.masked_values(mean * 2, 0)
+    outfile = os.path.join(tmp_path, "test_multiband.tif")
+    write_multiband(outfile, [mean, var], ["mean", "var"], (550000, 6150000), 1, 25832)
+    ds = gdal.Open(outfile)
+    assert ds.RasterCount == 2
+    assert ds.GetRasterBand(1).GetDescription() == "mean"
+    assert ds.GetRasterBand(2).GetDescription() == "var"
+    nodata = ds.GetRasterBand(2).GetNoDataValue()
+    assert nodata is not None and nodata not in mean
+    assert np.array_equal(ds.GetRasterBand(1).ReadAsArray(), mean)
+    assert int(np.sum(ds.GetRasterBand(2).ReadAsArray() == nodata)) == 1
+    ds = None
+
+
+def test_write_multiband_fully_masked(tmp_path):
+    from osgeo import gdal
+
+    mean = np.arange(1500).astype("float32").reshape((30, 50))
+    empty = np.ma.masked_all((30, 50), dtype="float32")
+    outfile = os.path.join(tmp_path, "test_multiband_masked.tif")
+    write_multiband(outfile, [mean, empty], None, (550000, 6150000), 1, 25832)
+    ds = gdal.Open(outfile)
+    assert ds.GetRasterBand(2).GetNoDataValue() == -99
+    assert np.all(ds.GetRasterBand(2).ReadAsArray() == -99)
+    ds = None
+
+    # A fully masked array on its own
+    outfile = os.path.join(tmp_path, "test_writer_masked.tif")
+    write_to_file(outfile, empty, (550000, 6150000), 1, 25832)
+    reader = RasterReader(outfile)
+    assert reader.nodata == -99
+    assert reader.read_raster(masked=True).mask.all()
+
+
+def test_find_nodata_value():
+    data = np.arange(1, 1501).astype("float32").reshape((30, 50))
+    assert find_nodata_value(data) == -99
+    assert find_nodata_value(data - 500) == -999
+    # Masked cells are ignored
+    assert find_nodata_value(np.ma.masked_less(data - 500, 0)) == -99
+    # Unsigned types fall back to 0 or positive nines
+    assert find_nodata_value(np.ma.masked_values(data.astype("uint8"), 0)) == 0
+    assert find_nodata_value(np.arange(50, dtype="uint8")) == 99
+    assert find_nodata_value(np.arange(-128, 127, dtype="int8")) == 127
@@ -0,0 +1,22 @@
+import numpy as np
+from surfclass.tiles import TILES_4KM, bboxes
+
+
+def test_tiles_4km():
+    assert len(TILES_4KM) == 16
+    assert TILES_4KM["n"].min() == 6177 and TILES_4KM["n"].max() == 6180
+    assert TILES_4KM["e"].min() == 722 and TILES_4KM["e"].max() == 725
+    assert tuple(TILES_4KM[0]) == (6177, 722)
+
+
+def test_bboxes():
+    boxes = bboxes(TILES_4KM)
+    assert boxes.shape == (16, 4)
+    assert boxes.dtype == np.float64
+    assert tuple(boxes[0]) == (722000, 6177000, 723000, 6178000)
+    # Extent of all tiles
+    assert tuple(boxes[:, :2].min(axis=0)) == (722000, 6177000)
+    assert tuple(boxes[:, 2:].max(axis=0)) == (726000, 6181000)
+
+    boxes = bboxes(TILES_4KM[:1], res_m=500)
+    assert tuple(boxes[0]) == (722000, 6177000, 722500, 6177500)